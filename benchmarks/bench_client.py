@@ -0,0 +1,175 @@
+"""
+Client benchmarks against local fake server (see benchmarks.fake_server).
+
+    python -m benchmarks.bench_client [--save baseline.json] [--compare baseline.json]
+
+Server runs in separate process, so it does not compete with measured client for the GIL.
+Results can be saved and compared with previous run - changes are reported in percents,
+positive numbers are always improvements.
+"""
+import datetime
+import gc
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import simplejson
+
+import invoicible
+from benchmarks import fake_server
+
+# name -> (unit, True when higher values are better)
+UNITS = {
+    'requests_sequential': ('req/s', True),
+    'requests_concurrent': ('req/s', True),
+    'requests_with_503s': ('req/s', True),
+    'manager_all': ('s', False),
+    'manager_iterator': ('s', False),
+    'manager_fetch_range': ('s', False),
+    'parse_json': ('us/object', False),
+    'parse_json_lazy': ('us/object', False),
+    'get_json': ('us/object', False),
+    'memory_per_object': ('bytes', False),
+}
+
+class ServerProcess(object):
+    def __init__(self, *args):
+        self.process = subprocess.Popen([sys.executable, '-m', 'benchmarks.fake_server', '--port', '0'] + list(args),
+                stdout=subprocess.PIPE)
+        line = self.process.stdout.readline()
+        if not line.startswith('listening on '):
+            self.process.kill()
+            raise RuntimeError('Fake server has not started: %r' % line)
+        self.domain = line.split()[-1]
+
+    def client(self, client_klass=invoicible.Client, **kwargs):
+        return client_klass(fake_server.CONSUMER_KEY, fake_server.CONSUMER_SECRET, fake_server.ACCESS_TOKEN_KEY,
+                fake_server.ACCESS_TOKEN_SECRET, invoicible_domain=self.domain, protocol='http', **kwargs)
+
+    def stop(self):
+        self.process.kill()
+        self.process.wait()
+
+def timed(fn, repeat=3):
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        fn()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def resident_memory():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except IOError:
+        # peak instead of current size - still fine as objects are allocated last
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def bench_requests(server, requests):
+    client = server.client()
+    uris = [customer['resource_uri'] for customer in client.get_resources('/api/1.0/customers/')]
+    paths = [uris[i % len(uris)] for i in range(requests)]
+    results = {}
+    results['requests_sequential'] = requests / timed(lambda: [client.get_resources(path) for path in paths])
+    async_client = server.client(invoicible.AsyncClient, max_workers=8)
+    try:
+        def concurrent():
+            futures = [async_client.get_resources_async(path) for path in paths]
+            for future in futures:
+                future.result()
+        results['requests_concurrent'] = requests / timed(concurrent)
+    finally:
+        async_client.close()
+    return results
+
+def bench_throttled(server, requests):
+    client = server.client(backoff=0.001, max_retries=10)
+    paths = ['/api/1.0/customers/%d/' % (i % 50 + 1) for i in range(requests)]
+    return {'requests_with_503s': requests / timed(lambda: [client.get_resources(path) for path in paths])}
+
+def bench_managers(server, year=2010):
+    client = server.client()
+    manager = invoicible.InvoiceManager(client)
+    return {
+        'manager_all': timed(manager.all),
+        'manager_iterator': timed(lambda: list(manager.iterator(page_size=100))),
+        'manager_fetch_range': timed(lambda: list(manager.fetch_range(
+            datetime.date(year, 1, 1), datetime.date(year, 12, 31), shard='month'))),
+    }
+
+def bench_codec(server, objects):
+    client = server.client()
+    resources = client.get_resources('/api/1.0/invoices/')
+    resources = (resources * (objects // len(resources) + 1))[:objects]
+    # fresh copies, so memoized values from previous runs are not reused
+    raw = simplejson.dumps(resources)
+    results = {}
+    results['parse_json'] = timed(
+        lambda: [invoicible.Invoice(client, json=r) for r in simplejson.loads(raw)]) / objects * 1e6
+    results['parse_json_lazy'] = timed(
+        lambda: [invoicible.Invoice(client, json=r, lazy=True) for r in simplejson.loads(raw)]) / objects * 1e6
+    built = [invoicible.Invoice(client, json=r) for r in resources]
+    results['get_json'] = timed(lambda: [invoice.get_json() for invoice in built]) / objects * 1e6
+    built = None
+    loaded = simplejson.loads(raw)
+    gc.collect()
+    before = resident_memory()
+    invoices = [invoicible.Invoice(client, json=r) for r in loaded]
+    gc.collect()
+    results['memory_per_object'] = float(resident_memory() - before) / len(invoices)
+    return results
+
+def run(options):
+    results = {}
+    server = ServerProcess('--invoices', str(options.invoices))
+    try:
+        results.update(bench_requests(server, options.requests))
+        results.update(bench_managers(server))
+        results.update(bench_codec(server, options.objects))
+    finally:
+        server.stop()
+    server = ServerProcess('--error-rate', str(options.error_rate))
+    try:
+        results.update(bench_throttled(server, options.requests))
+    finally:
+        server.stop()
+    return results
+
+def report(results, baseline=None):
+    lines = []
+    for name in sorted(results):
+        unit, higher_is_better = UNITS[name]
+        line = '%-22s %12.2f %-10s' % (name, results[name], unit)
+        if baseline and baseline.get(name):
+            change = (results[name] - baseline[name]) / baseline[name] * 100
+            line += ' %12.2f %+8.1f%%' % (baseline[name], change if higher_is_better else -change)
+        lines.append(line)
+    return '\n'.join(lines)
+
+def main():
+    parser = optparse.OptionParser(usage='python -m benchmarks.bench_client [options]')
+    parser.add_option('--save', help='store results as json baseline')
+    parser.add_option('--compare', help='compare results with json baseline')
+    parser.add_option('--requests', type='int', default=500)
+    parser.add_option('--invoices', type='int', default=1000)
+    parser.add_option('--objects', type='int', default=20000)
+    parser.add_option('--error-rate', type='float', default=0.1)
+    options, args = parser.parse_args()
+    invoicible.DEBUG = False
+    baseline = None
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = simplejson.load(baseline_file)
+    results = run(options)
+    print report(results, baseline)
+    if options.save:
+        with open(options.save, 'w') as baseline_file:
+            simplejson.dump(results, baseline_file, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
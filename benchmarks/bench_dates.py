@@ -0,0 +1,44 @@
+"""
+Compares strptime/strftime with invoicible fixed format date codec.
+
+    python -m benchmarks.bench_dates [number]
+"""
+import datetime
+import sys
+import timeit
+
+import invoicible
+
+# typical list page - few hundred objects sharing a couple of dates
+DATES = ['2010-%02d-%02d' % (month, day) for month in (1, 2, 3) for day in range(1, 29)] * 4
+DATETIMES = [date + ' 12:%02d:00' % (i % 60) for i, date in enumerate(DATES)]
+
+def run(number=100):
+    cases = [
+        ('date strptime', lambda: [datetime.datetime.strptime(d, invoicible.DATE_FORMAT).date() for d in DATES]),
+        ('date codec', lambda: [invoicible.parse_date(d) for d in DATES]),
+        # every page starts with empty memo table
+        ('date codec cold', lambda: invoicible._date_memo.clear() or [invoicible.parse_date(d) for d in DATES]),
+        ('datetime strptime', lambda: [datetime.datetime.strptime(d, invoicible.DATETIME_FORMAT) for d in DATETIMES]),
+        ('datetime codec', lambda: [invoicible.parse_datetime(d) for d in DATETIMES]),
+    ]
+    dates = [invoicible.parse_date(d) for d in DATES]
+    cases += [
+        ('date strftime', lambda: [d.strftime(invoicible.DATE_FORMAT) for d in dates]),
+        ('date codec encode', lambda: [invoicible.format_date(d) for d in dates]),
+    ]
+    results = {}
+    for name, fn in cases:
+        results[name] = min(timeit.repeat(fn, number=number, repeat=3)) / (number * len(DATES))
+    return results
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    results = run(number)
+    for baseline, fast in (('date strptime', 'date codec'), ('date strptime', 'date codec cold'),
+            ('datetime strptime', 'datetime codec'), ('date strftime', 'date codec encode')):
+        print '%-20s %8.3f us' % (baseline, results[baseline] * 1e6)
+        print '%-20s %8.3f us  (%.1fx)' % (fast, results[fast] * 1e6, results[baseline] / results[fast])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Compares per line Decimal loop with invoicible_reports columnar table on synthetic invoices.
+
+    python -m benchmarks.bench_reports [lines]
+"""
+import decimal
+import random
+import sys
+import time
+
+import invoicible_reports
+
+def invoices(lines, items_per_invoice=5, seed=0):
+    rng = random.Random(seed)
+    prices = ['%d.%02d' % (rng.randint(0, 999), rng.randint(0, 99)) for i in range(500)]
+    for i in xrange(lines // items_per_invoice):
+        yield {
+            'resource_uri': '/api/1.0/invoices/%d/' % i,
+            'customer_uri': '/api/1.0/customers/%d/' % (i % 300),
+            'date': '2010-%02d-%02d' % (i % 12 + 1, i % 28 + 1),
+            'currency_symbol': 'EUR' if i % 4 else 'PLN',
+            'items': [{
+                'amount': rng.choice(('1', '2', '0.5', '10')),
+                'unit_price': rng.choice(prices),
+                'tax_rate': rng.choice(('23', '8', '5', 'zw')),
+                'product_id': 'p%d' % rng.randint(0, 50),
+            } for j in range(items_per_invoice)],
+        }
+
+def decimal_loop(data):
+    totals = {}
+    for invoice in data:
+        key = (invoice['customer_uri'], invoice['date'][:7])
+        for item in invoice['items']:
+            net = decimal.Decimal(item['amount']) * decimal.Decimal(item['unit_price'])
+            try:
+                rate = decimal.Decimal(item['tax_rate'])
+            except decimal.InvalidOperation:
+                rate = 0
+            total = totals.setdefault(key, [0, 0])
+            total[0] += net
+            total[1] += net * rate / 100
+    return totals
+
+def timed(fn, *args):
+    started = time.time()
+    result = fn(*args)
+    return time.time() - started, result
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    data = list(invoices(lines))
+    loop_time, expected = timed(decimal_loop, data)
+    table = invoicible_reports.LineItemTable()
+    load_time, _ = timed(table.load, data)
+    net_time, net = timed(table.net, ('customer', 'month'))
+    tax_time, tax = timed(table.tax, ('customer', 'month'))
+    assert all(net[key] == value[0] and tax[key] == value[1] for key, value in expected.iteritems())
+    print '%d lines' % len(table)
+    print '%-28s %8.3f s' % ('decimal loop (net + tax)', loop_time)
+    print '%-28s %8.3f s' % ('table load', load_time)
+    print '%-28s %8.3f s' % ('table net by customer,month', net_time)
+    print '%-28s %8.3f s' % ('table tax by customer,month', tax_time)
+    for name, by in (('total gross', None), ('gross by currency', 'currency'), ('report by tax_rate', 'tax_rate')):
+        print '%-28s %8.3f s' % (name, timed(table.report, by)[0])
+
+if __name__ == '__main__':
+    main()
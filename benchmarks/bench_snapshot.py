@@ -0,0 +1,54 @@
+"""
+Compares rebuilding invoices from json with loading them from snapshot.
+
+    python -m benchmarks.bench_snapshot [invoices]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import simplejson
+
+import invoicible
+import invoicible_snapshot
+from benchmarks import fake_server
+
+def timed(fn):
+    started = time.time()
+    result = fn()
+    return time.time() - started, result
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    invoicible.DEBUG = False
+    data = fake_server.FakeData(customers=1000, invoices=count, estimates=0, comments=0)
+    client = invoicible.Client('key', 'secret', 'token', 'secret')
+    customers = dict((uri, invoicible.Customer(client, json=customer))
+            for uri, customer in data.collections['customers'].items())
+    invoices = []
+    for uri in data.order['invoices']:
+        invoice = invoicible.Invoice(client, json=data.collections['invoices'][uri], lazy=True)
+        invoice.customer = customers[invoice.customer_uri]
+        invoices.append(invoice)
+    raw = simplejson.dumps([data.collections['invoices'][uri] for uri in data.order['invoices']])
+    path = os.path.join(tempfile.mkdtemp(), 'invoices.snapshot')
+
+    dump_time, records = timed(lambda: invoicible_snapshot.dump(path, invoices))
+    json_time, parsed = timed(lambda: [invoicible.Invoice(client, json=r) for r in simplejson.loads(raw)])
+    open_time, snapshot = timed(lambda: invoicible_snapshot.load(path, invoicible.Client('key', 'secret', 'token', 'secret')))
+    first_time, first = timed(lambda: snapshot.get(invoices[-1].resource_uri).customer.name)
+    all_time, loaded = timed(lambda: list(snapshot.objects(invoicible.Invoice)))
+    assert len(loaded) == len(parsed) == count
+
+    print '%d invoices, %d records, %.1f MB snapshot' % (count, records, os.path.getsize(path) / 1e6)
+    print '%-32s %10.3f s' % ('json loads + parse_json', json_time)
+    print '%-32s %10.3f s' % ('snapshot dump', dump_time)
+    print '%-32s %10.3f ms' % ('snapshot open', open_time * 1000)
+    print '%-32s %10.3f ms' % ('first invoice with customer', first_time * 1000)
+    print '%-32s %10.3f s' % ('materialize all invoices', all_time)
+    snapshot.close()
+    os.remove(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+# -coding: utf-8 -
+"""
+Local stand-in for invoicible api used by benchmarks.
+
+Serves generated customers, invoices, estimates and their comments under /api/1.0/ with
+OAuth signature checking, offset/limit and date_from/date_to filtering, ETag validation,
+optional latency, injected 503 (throttled) responses and gzip compression.
+
+    python -m benchmarks.fake_server [--port 8000] [--latency 0.01] [--error-rate 0.05]
+
+or in process:
+
+    server = FakeInvoicibleServer(invoices=1000).start()
+    client = server.client()
+    ...
+    server.stop()
+"""
+import BaseHTTPServer
+import datetime
+import hashlib
+import optparse
+import random
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+import oauth.oauth as oauth
+import simplejson
+
+import invoicible
+
+CONSUMER_KEY = 'bench-consumer'
+CONSUMER_SECRET = 'bench-consumer-secret'
+ACCESS_TOKEN_KEY = 'bench-token'
+ACCESS_TOKEN_SECRET = 'bench-token-secret'
+
+API_PREFIX = '/api/1.0/'
+COLLECTIONS = ('customers', 'invoices', 'estimates')
+
+class FakeData(object):
+    """
+    Generated account content - collections are ordered dicts of resource_uri -> json.
+    """
+    def __init__(self, customers=100, invoices=1000, estimates=200, comments=2, items=5, seed=0,
+            first_date=datetime.date(2010, 1, 1), days=365):
+        rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.collections = dict((name, {}) for name in COLLECTIONS)
+        self.order = dict((name, []) for name in COLLECTIONS)
+        self.comments = {}
+        self.next_id = 1
+        for i in range(customers):
+            self.add('customers', {
+                'name': u'Customer %d' % i,
+                'address': u'Long Street %d\n00-%03d Warsaw' % (i, i % 1000),
+                'contact': u'Contact %d' % i,
+                'email': u'customer%d@example.com' % i,
+                'tax_id': u'%010d' % rng.randint(0, 10 ** 10 - 1),
+            })
+        customer_uris = self.order['customers']
+        for kind, count in (('invoices', invoices), ('estimates', estimates)):
+            dates = sorted(first_date + datetime.timedelta(days=rng.randint(0, days - 1)) for i in range(count))
+            for i, date in enumerate(dates):
+                customer_uri = customer_uris[rng.randint(0, len(customer_uris) - 1)] if customer_uris else None
+                customer = self.collections['customers'].get(customer_uri, {})
+                resource = self.add(kind, {
+                    'customer_uri': customer_uri,
+                    'customer_name': customer.get('name'),
+                    'customer_address': customer.get('address'),
+                    'customer_tax_id': customer.get('tax_id'),
+                    'currency_symbol': rng.choice([u'zł', u'EUR']),
+                    'date': date.strftime(invoicible.DATE_FORMAT),
+                    'date_raised': date.strftime(invoicible.DATE_FORMAT),
+                    'payment_due': (date + datetime.timedelta(days=14)).strftime(invoicible.DATE_FORMAT),
+                    'invoice_id': u'%d/%d' % (i + 1, date.year),
+                    'invoice_type': u'vat',
+                    'language': u'pl',
+                    'status': rng.choice([u'draft', u'sent', u'paid']),
+                    'summary': u'Services %d' % i,
+                    'items': [{
+                        'amount': rng.choice([u'1', u'2', u'0.5', u'10']),
+                        'description': u'Item %d of document %d' % (j, i),
+                        'product_id': u'P%03d' % rng.randint(0, 99),
+                        'tax_rate': rng.choice([u'23', u'8', u'5', u'zw']),
+                        'unit': rng.choice([u'szt.', u'h']),
+                        'unit_price': u'%d.%02d' % (rng.randint(1, 999), rng.randint(0, 99)),
+                    } for j in range(items)],
+                })
+                self.comments[resource['resource_uri']] = [
+                    {'body': u'Comment %d' % j, 'summary': u'Note %d' % j} for j in range(comments)]
+
+    def add(self, kind, resource):
+        resource = dict(resource)
+        resource_uri = '%s%s/%d/' % (API_PREFIX, kind, self.next_id)
+        self.next_id += 1
+        resource['resource_uri'] = resource_uri
+        if kind != 'customers':
+            resource['comments_uri'] = resource_uri + 'comments/'
+            self.comments.setdefault(resource_uri, [])
+        self.collections[kind][resource_uri] = resource
+        self.order[kind].append(resource_uri)
+        return resource
+
+    def list(self, kind, query):
+        date_from, date_to = query.get('date_from'), query.get('date_to')
+        resources = []
+        for resource_uri in self.order[kind]:
+            resource = self.collections[kind][resource_uri]
+            date = resource.get('date')
+            if date_from and (date is None or date < date_from):
+                continue
+            if date_to and (date is None or date > date_to):
+                continue
+            resources.append(resource)
+        offset = int(query.get('offset', 0))
+        if 'limit' in query:
+            return resources[offset:offset + int(query['limit'])]
+        return resources[offset:]
+
+    def remove(self, kind, resource_uri):
+        del self.collections[kind][resource_uri]
+        self.order[kind].remove(resource_uri)
+        self.comments.pop(resource_uri, None)
+
+class FakeApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # buffered output - unbuffered one sends every header line in its own packet and
+    # keep-alive responses stall on delayed ACKs
+    wbufsize = -1
+    signature_method = oauth.OAuthSignatureMethod_HMAC_SHA1()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send(self, status, body='', headers=None):
+        if not isinstance(body, str):
+            body = simplejson.dumps(body)
+        headers = dict(headers or {})
+        if self.command == 'GET' and status == 200:
+            headers['ETag'] = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get('if-none-match') == headers['ETag']:
+                status, body = invoicible.NOT_MODIFIED, ''
+        if self.server.compress and body and 'gzip' in (self.headers.get('accept-encoding') or ''):
+            body = invoicible.gzip_compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        headers.setdefault('Content-Type', 'application/json')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get('content-length') or 0))
+        if self.headers.get('content-encoding') == 'gzip':
+            decoder = invoicible.ContentDecoder('gzip')
+            body = decoder.decompress(body) + decoder.flush()
+        return simplejson.loads(body) if body else {}
+
+    def authorized(self):
+        if not self.server.check_oauth:
+            return True
+        url = 'http://%s%s' % (self.headers.get('host'), self.path)
+        try:
+            request = oauth.OAuthRequest.from_request(self.command, url,
+                    headers={'Authorization': self.headers.get('authorization') or ''})
+            if request is None:
+                return False
+            signature = request.get_parameter('oauth_signature')
+        except oauth.OAuthError:
+            return False
+        if request.get_parameter('oauth_consumer_key') != self.server.consumer.key or \
+          request.get_parameter('oauth_token') != self.server.token.key:
+            return False
+        return self.signature_method.check_signature(request, self.server.consumer, self.server.token, signature)
+
+    def handle_request(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if server.inject_error():
+            return self.send(invoicible.THROTTLED, {'error': 'throttled'}, {'Retry-After': '0'})
+        if not self.authorized():
+            return self.send(invoicible.FORBIDDEN, {'error': 'invalid signature'})
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        parts = url.path[len(API_PREFIX):].strip('/').split('/') if url.path.startswith(API_PREFIX) else []
+        if not parts or parts[0] not in COLLECTIONS or len(parts) > 3 or \
+          (len(parts) == 3 and parts[2] != 'comments'):
+            return self.send(invoicible.NOT_FOUND, {'error': 'not found'})
+        kind = parts[0]
+        data = server.data
+        with data.lock:
+            if len(parts) == 1:
+                if self.command == 'GET':
+                    return self.send(200, data.list(kind, query))
+                if self.command == 'POST':
+                    return self.send(200, data.add(kind, self.read_body()))
+                return self.send(invoicible.NOT_IMPLEMENTED, {'error': 'not implemented'})
+            resource_uri = '%s%s/%s/' % (API_PREFIX, kind, parts[1])
+            resource = data.collections[kind].get(resource_uri)
+            if resource is None:
+                return self.send(invoicible.NOT_FOUND, {'error': 'not found'})
+            if len(parts) == 3:
+                return self.send(200, data.comments.get(resource_uri, []))
+            if self.command == 'GET':
+                return self.send(200, resource)
+            if self.command == 'PUT':
+                resource.update(self.read_body())
+                resource['resource_uri'] = resource_uri
+                return self.send(200, resource)
+            if self.command == 'DELETE':
+                data.remove(kind, resource_uri)
+                return self.send(invoicible.DELETED)
+        return self.send(invoicible.NOT_IMPLEMENTED, {'error': 'not implemented'})
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+class FakeInvoicibleServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, data=None, latency=0.0, error_rate=0.0, compress=False,
+            check_oauth=True, seed=0, verbose=False, **data_options):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeApiHandler)
+        self.data = data if data is not None else FakeData(seed=seed, **data_options)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.compress = compress
+        self.check_oauth = check_oauth
+        self.verbose = verbose
+        self.consumer = oauth.OAuthConsumer(CONSUMER_KEY, CONSUMER_SECRET)
+        self.token = oauth.OAuthToken(ACCESS_TOKEN_KEY, ACCESS_TOKEN_SECRET)
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def domain(self):
+        return '%s:%d' % self.server_address[:2]
+
+    def inject_error(self):
+        if not self.error_rate:
+            return False
+        with self._random_lock:
+            return self._random.random() < self.error_rate
+
+    def client(self, client_klass=invoicible.Client, **kwargs):
+        """
+        Returns client configured to talk to this server.
+        """
+        return client_klass(CONSUMER_KEY, CONSUMER_SECRET, ACCESS_TOKEN_KEY, ACCESS_TOKEN_SECRET,
+                invoicible_domain=self.domain, protocol='http', **kwargs)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main():
+    parser = optparse.OptionParser(usage='python -m benchmarks.fake_server [options]')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=8000, help='0 picks free port')
+    parser.add_option('--latency', type='float', default=0.0, help='seconds added to every response')
+    parser.add_option('--error-rate', type='float', default=0.0, help='fraction of requests answered with 503')
+    parser.add_option('--compress', action='store_true', help='gzip responses when client accepts it')
+    parser.add_option('--no-oauth', action='store_false', dest='check_oauth', default=True)
+    parser.add_option('--customers', type='int', default=100)
+    parser.add_option('--invoices', type='int', default=1000)
+    parser.add_option('--estimates', type='int', default=200)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--verbose', action='store_true')
+    options, args = parser.parse_args()
+    server = FakeInvoicibleServer(options.host, options.port, latency=options.latency,
+            error_rate=options.error_rate, compress=options.compress, check_oauth=options.check_oauth,
+            seed=options.seed, verbose=options.verbose, customers=options.customers,
+            invoices=options.invoices, estimates=options.estimates)
+    # benchmark runner reads this line to find the port
+    print 'listening on %s' % server.domain
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
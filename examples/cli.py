@@ -1,12 +1,32 @@
+"""
+Example invoicible api client.
+
+Without arguments it starts interactive command line (generating access token first when
+needed). With arguments it runs single command, or commands read from stdin (one per line)
+when command is "-", reusing one client, and exits:
+
+    python cli.py list invoices --from 2010-01-01 --to 2010-01-31 --fields resource_uri,summary --format tsv
+    python cli.py delete /api/1.0/invoices/1/ /api/1.0/invoices/2/
+    echo "export invoices invoices.csv.gz --items" | python cli.py -
+
+Keys and domain are taken from this file or INVOICIBLE_CONSUMER_KEY, INVOICIBLE_CONSUMER_SECRET,
+INVOICIBLE_ACCESS_TOKEN_KEY, INVOICIBLE_ACCESS_TOKEN_SECRET and INVOICIBLE_DOMAIN variables.
+List responses are kept in on-disk cache (separate directory for every domain and access
+token), so unchanged pages are not downloaded again by following invocations.
+"""
+# modules used only by interactive mode (webbrowser, readline, shlex...) are imported
+# where needed, so batch invocations start fast
 import cmd
-import copy
+import errno
+import hashlib
 import httplib
 import oauth.oauth as oauth
-import pprint
-import readline
+import optparse
+import os
 import sys
 import urlparse
-import webbrowser
+
+import simplejson
 
 import invoicible
 
@@ -20,6 +40,14 @@ ACCESS_TOKEN_SECRET = ''
 
 COMPANY_DOMAIN = ''
 
+CACHE_DIRECTORY = '~/.cache/invoicible'
+
+MANAGERS = {
+    'invoices': invoicible.InvoiceManager,
+    'estimates': invoicible.EstimateManager,
+    'customers': invoicible.CustomerManager,
+}
+
 def ask(question):
     while True:
         result = raw_input(question)
@@ -66,6 +94,7 @@ class InvoicibleOAuthHelper(oauth.OAuthClient):
         return self._request_token
 
     def fetch_verifier(self, url):
+        import webbrowser
         webbrowser.open_new(url)
         verifier = raw_input('Copy verifier which you should see on page after autorization:')
         return verifier
@@ -92,6 +121,147 @@ class InvoicibleOAuthHelper(oauth.OAuthClient):
         self.access_token = oauth.OAuthToken.from_string(response.read())
         return self.access_token
 
+def make_list_parser():
+    parser = optparse.OptionParser(usage="list invoices|estimates|customers [options]", add_help_option=False)
+    parser.add_option("--from", dest="date_from", help="YYYY-MM-DD")
+    parser.add_option("--to", dest="date_to", help="YYYY-MM-DD")
+    parser.add_option("--status")
+    parser.add_option("--customer", help="customer resource uri")
+    parser.add_option("--offset", type="int", default=0)
+    parser.add_option("--limit", type="int", help="max number of listed objects (all by default)")
+    parser.add_option("--page-size", type="int", default=100)
+    parser.add_option("--fields", help="comma separated fields (all by default)")
+    parser.add_option("--format", choices=("jsonl", "tsv"), default="jsonl")
+    return parser
+
+def make_export_parser():
+    import invoicible_export
+    parser = optparse.OptionParser(usage="export invoices|estimates|customers path [options]", add_help_option=False)
+    parser.add_option("--format", choices=invoicible_export.FORMATS, help="csv or jsonl (guessed from path by default)")
+    parser.add_option("--gzip", action="store_true", dest="compress", help="compress output (default for .gz paths)")
+    parser.add_option("--columns", help="comma separated resource fields")
+    parser.add_option("--items", action="store_true", help="write one row per invoice/estimate item")
+    parser.add_option("--item-columns", help="comma separated item fields (implies --items)")
+    parser.add_option("--from", dest="date_from", help="YYYY-MM-DD")
+    parser.add_option("--to", dest="date_to", help="YYYY-MM-DD")
+    parser.add_option("--page-size", type="int", default=100)
+    return parser
+
+class CommandRunner(object):
+    """
+    Runs list, delete and export commands given as argument lists - results are written
+    to output as soon as every page arrives.
+    """
+    commands = ('list', 'delete', 'export')
+
+    def __init__(self, client, output=sys.stdout, errors=sys.stderr):
+        self.client = client
+        self.output = output
+        self.errors = errors
+        self.list_parser = make_list_parser()
+        self._export_parser = None
+
+    @property
+    def export_parser(self):
+        if self._export_parser is None:
+            self._export_parser = make_export_parser()
+        return self._export_parser
+
+    def run(self, args):
+        """
+        Returns True when command succeeded, errors are reported to errors stream.
+        """
+        if not args or args[0] not in self.commands:
+            self.errors.write("Unknown command: %s (use one of: %s)\n" % (' '.join(args), ', '.join(self.commands)))
+            return False
+        try:
+            getattr(self, 'do_' + args[0])(args[1:])
+        except SystemExit:
+            # optparse has already printed usage
+            return False
+        except (invoicible.InvoicibleApiError, ValueError), e:
+            self.errors.write("%s: %s\n" % (args[0], e))
+            return False
+        return True
+
+    def do_list(self, args):
+        options, args = self.list_parser.parse_args(args)
+        if len(args) != 1 or args[0] not in MANAGERS:
+            self.list_parser.error("list invoices, estimates or customers")
+        manager = MANAGERS[args[0]](self.client)
+        if (options.date_from or options.date_to) and \
+          not isinstance(manager, invoicible.DateSliceableApiObjectManager):
+            self.list_parser.error("%s can't be filtered by date" % args[0])
+        fields = options.fields.split(',') if options.fields else None
+        filters = [(field, value) for field, value in (('status', options.status),
+                ('customer_uri', options.customer)) if value is not None]
+        for resources in self._pages(manager, options):
+            for resource in resources:
+                if all(resource.get(field) == value for field, value in filters):
+                    self._write(resource, fields, options.format)
+            self.output.flush()
+
+    def _pages(self, manager, options):
+        dates = {}
+        if options.date_from:
+            dates['date_from'] = options.date_from
+        if options.date_to:
+            dates['date_to'] = options.date_to
+        if not options.offset and options.limit is None:
+            # next page is fetched while current one is written
+            return manager.pages(page_size=options.page_size, **dates)
+        return self._slice(manager, options, dates)
+
+    def _slice(self, manager, options, query):
+        offset, remaining = options.offset, options.limit
+        while remaining is None or remaining > 0:
+            limit = options.page_size if remaining is None else min(options.page_size, remaining)
+            resources = self.client.get_resources(manager.api_klass._resources_uri,
+                    dict(query, offset=offset, limit=limit))
+            yield resources
+            if len(resources) < limit:
+                return
+            offset += limit
+            if remaining is not None:
+                remaining -= limit
+
+    def _write(self, resource, fields, format):
+        if format == 'tsv':
+            values = [resource.get(field) for field in fields or sorted(resource)]
+            line = u'\t'.join(u'' if value is None else unicode(value).replace(u'\t', u' ').replace(u'\n', u' ')
+                    for value in values)
+            self.output.write(line.encode('utf-8') + '\n')
+        else:
+            if fields:
+                resource = dict((field, resource.get(field)) for field in fields)
+            self.output.write(simplejson.dumps(resource, sort_keys=True) + '\n')
+
+    def do_delete(self, args):
+        if not args:
+            raise ValueError("usage: delete resource_uri [resource_uri ...]")
+        for resource_uri in args:
+            self.client.delete_resource(resource_uri)
+            self.output.write(resource_uri + '\n')
+            self.output.flush()
+
+    def do_export(self, args):
+        import invoicible_export
+        options, args = self.export_parser.parse_args(args)
+        if len(args) != 2 or args[0] not in invoicible_export.MANAGERS:
+            self.export_parser.error("export invoices, estimates or customers to path")
+        count = invoicible_export.export(
+            self.client, args[0], args[1],
+            format=options.format,
+            columns=options.columns and options.columns.split(','),
+            items=options.items,
+            item_columns=options.item_columns and options.item_columns.split(','),
+            compress=options.compress,
+            page_size=options.page_size,
+            date_from=options.date_from,
+            date_to=options.date_to,
+        )
+        self.output.write("%d rows written to %s\n" % (count, args[1]))
+
 class SimpleClientCommandLine(cmd.Cmd):
     """
     Really simple invoicible application. It allows to list and updates some resources through api.
@@ -101,6 +271,7 @@ class SimpleClientCommandLine(cmd.Cmd):
         self.customer_manager = invoicible.CustomerManager(self.client)
         self.estimate_manager = invoicible.EstimateManager(self.client)
         self.invoice_manager = invoicible.InvoiceManager(self.client)
+        self.runner = CommandRunner(self.client)
 
         self.prompt = "invoicible$ "
         self.intro = "\nThis is really simple invoicible api client. Type 'help' or '?' for usage hints.\n"
@@ -111,38 +282,32 @@ class SimpleClientCommandLine(cmd.Cmd):
         print "list"
         #print "create"
         print "delete"
+        print "export"
         print "quit"
 
     def help_delete(self):
-        print "delete resource_uri"
+        print "delete resource_uri [resource_uri ...]"
 
     def do_delete(self, line):
-        args = line.split()
-        if len(args) != 1:
-            return self.help_delete()
-        else:
-            self.client.delete_resource(args[0])
+        self.runner.run(['delete'] + line.split())
 
     def help_list(self):
-        print "list invoices|estimates|customers"
+        self.runner.list_parser.print_help()
 
     def do_list(self, line):
-        args = line.split()
-        if len(args) != 1 or args[0] not in ['invoices', 'customers', 'estimates']:
-            return self.help_list()
-
-        if args[0] == 'customers':
-            result = self.customer_manager.all()
-        elif args[0] == 'estimates':
-            result = self.estimate_manager.all()
-        else:
-            result = self.invoice_manager.all()
-
-        pprint.pprint(result)
+        self.runner.run(['list'] + line.split())
 
     def complete_list(self, line, *args):
         return [ command for command in ('invoices', 'customers', 'estimates') if command.startswith(line)]
 
+    def help_export(self):
+        self.runner.export_parser.print_help()
+
+    def do_export(self, line):
+        self.runner.run(['export'] + line.split())
+
+    complete_export = complete_list
+
     def do_EOF(self, line):
         print ""
         return 1
@@ -189,8 +354,80 @@ into this file (%s) so next time you will skip application autorization step.
         access_token_secret,
         invoicible_domain = company_domain,
     )
+    # line editing for cmd
+    import readline
     command_line = SimpleClientCommandLine(invoicible_client)
     command_line.cmdloop()
 
+def make_batch_parser():
+    parser = optparse.OptionParser(usage="%prog [options] [list|delete|export|- [command options]]")
+    # options after command name belong to the command
+    parser.disable_interspersed_args()
+    parser.add_option("--domain", default=os.environ.get('INVOICIBLE_DOMAIN', COMPANY_DOMAIN))
+    parser.add_option("--protocol", choices=("https", "http"), default="https")
+    parser.add_option("--cache-dir", default=CACHE_DIRECTORY,
+        help="persistent response cache, per domain and access token subdirectories are used (default %default)")
+    parser.add_option("--no-cache", action="store_const", const=None, dest="cache_dir")
+    parser.add_option("--max-connections", type="int", default=4)
+    return parser
+
+def cache_directory(base, domain, access_token_key):
+    # accounts never share cached responses
+    return os.path.join(os.path.expanduser(base), domain.replace(os.sep, '_'),
+        hashlib.sha1(access_token_key).hexdigest()[:16])
+
+def build_client(options):
+    keys = [os.environ.get('INVOICIBLE_' + name, default) for name, default in (
+        ('CONSUMER_KEY', CONSUMER_KEY), ('CONSUMER_SECRET', CONSUMER_SECRET_KEY),
+        ('ACCESS_TOKEN_KEY', ACCESS_TOKEN_KEY), ('ACCESS_TOKEN_SECRET', ACCESS_TOKEN_SECRET))]
+    if not all(keys) or not options.domain:
+        raise ValueError("consumer keys, access token and domain are required - run without arguments "
+            "to generate access token, see %s for details" % __file__)
+    response_cache = None
+    if options.cache_dir:
+        response_cache = invoicible.ResponseCache(invoicible.DiskCacheBackend(
+            cache_directory(options.cache_dir, options.domain, keys[2])))
+    return invoicible.Client(*keys,
+        invoicible_domain=options.domain,
+        protocol=options.protocol,
+        max_connections=options.max_connections,
+        response_cache=response_cache
+    )
+
+def run_batch(options, args):
+    """
+    Runs command from args or, when args is ["-"], commands read from stdin.
+    Returns exit status.
+    """
+    try:
+        client = build_client(options)
+    except ValueError, e:
+        sys.stderr.write("%s\n" % e)
+        return 2
+    runner = CommandRunner(client)
+    succeeded = True
+    try:
+        if args == ['-']:
+            import shlex
+            for line in sys.stdin:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    succeeded = runner.run(shlex.split(line)) and succeeded
+        else:
+            succeeded = runner.run(args)
+    except IOError, e:
+        # output closed by the other end of a pipe (e.g. head)
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        client.pool.close()
+    return 0 if succeeded else 1
+
+def main(argv=None):
+    options, args = make_batch_parser().parse_args(argv)
+    if not args:
+        return run_example()
+    sys.exit(run_batch(options, args))
+
 if __name__ == "__main__":
-    run_example()
+    main()
@@ -1,14 +1,32 @@
 # -coding: utf-8 -
+import binascii
+import codecs
+import collections
+import copy
 import datetime
 import decimal
+import email.utils
+import hashlib
+import hmac
 import httplib
+import itertools
+import math
 import oauth.oauth as oauth
+import os
 import pprint
+import Queue
+import random
+import select
 import simplejson
+import socket
+import sys
+import threading
+import time
 import urllib
-import urlparse
+import zlib
 
 DELETED = 204
+NOT_MODIFIED = 304
 BAD_REQUEST = 400
 FORBIDDEN = 401
 NOT_FOUND = 404
@@ -23,127 +41,1170 @@ DEBUG=True
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 DATE_FORMAT = '%Y-%m-%d'
 
-class DoesNotExists(Exception):
+class InvoicibleApiError(Exception):
+    status = None
+
+    def __init__(self, *args, **kwargs):
+        self.status = kwargs.pop('status', self.status)
+        self.body = kwargs.pop('body', None)
+        Exception.__init__(self, *args)
+
+class DoesNotExists(InvoicibleApiError):
     pass
 
-class ValidationError(Exception):
+class ValidationError(InvoicibleApiError):
     pass
 
+class BadRequest(ValidationError):
+    status = BAD_REQUEST
+
+class Forbidden(InvoicibleApiError):
+    status = FORBIDDEN
+
+class NotFound(DoesNotExists):
+    status = NOT_FOUND
+
+class DuplicateEntry(ValidationError):
+    status = DUPLICATE_ENTRY
+
+class Gone(DoesNotExists):
+    status = NOT_HERE
+
+class InternalError(InvoicibleApiError):
+    status = INTERNAL_ERROR
+
+class MethodNotImplemented(InvoicibleApiError):
+    status = NOT_IMPLEMENTED
+
+class PoolTimeout(InvoicibleApiError):
+    """
+    No pooled connection was released within pool_timeout seconds.
+    """
+
+class Throttled(InvoicibleApiError):
+    status = THROTTLED
+
+    def __init__(self, *args, **kwargs):
+        self.retry_after = kwargs.pop('retry_after', None)
+        InvoicibleApiError.__init__(self, *args, **kwargs)
+
+STATUS_ERRORS = dict((error.status, error) for error in (
+    BadRequest, Forbidden, NotFound, DuplicateEntry, Gone, InternalError, MethodNotImplemented, Throttled
+))
+
+# (error class, caller's default error class) -> subclass of both
+_compatible_errors = {}
+
+def compatible_error(error_klass, default):
+    """
+    Returns subclass of error_klass which is also subclass of default, so except clauses
+    written for errors raised before typed errors (DoesNotExists, ValidationError) still
+    match. Throttled is returned as it is - 503 doesn't mean missing or invalid object.
+    """
+    if issubclass(error_klass, (default, Throttled)):
+        return error_klass
+    try:
+        return _compatible_errors[(error_klass, default)]
+    except KeyError:
+        klass = _compatible_errors[(error_klass, default)] = type(error_klass.__name__, (error_klass, default), {})
+        return klass
+
+def parse_retry_after(value):
+    """
+    Returns number of seconds from Retry-After header (delta seconds or http date).
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(email.utils.mktime_tz(parsed) - time.time(), 0)
+
+class RateLimiter(object):
+    """
+    Token bucket shared by all client requests. Its rate adapts to the server: it is lowered
+    multiplicatively on every throttled response and raised additively (by about increase
+    requests/s every second) on successful ones. Retry-After pauses all requests.
+    """
+    def __init__(self, rate=10.0, burst=10, min_rate=0.5, max_rate=100.0, increase=1.0, decrease=0.5):
+        self.rate = float(rate)
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self._tokens = float(burst)
+        self._updated_at = time.time()
+        self._blocked_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_throttled(self, retry_after=None):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, 0)
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, time.time() + retry_after)
+
+class IdentityMap(object):
+    """
+    Bounded resource_uri -> api object cache. Least recently used entries are evicted
+    when max_size is exceeded and entries older than ttl seconds (if given) are dropped.
+    """
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, resource_uri):
+        with self._lock:
+            try:
+                api_object, stored_at = self._entries.pop(resource_uri)
+            except KeyError:
+                return None
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                return None
+            self._entries[resource_uri] = (api_object, stored_at)
+            return api_object
+
+    def set(self, resource_uri, api_object):
+        with self._lock:
+            self._entries.pop(resource_uri, None)
+            self._entries[resource_uri] = (api_object, time.time())
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, resource_uri):
+        with self._lock:
+            self._entries.pop(resource_uri, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, resource_uri):
+        return self.get(resource_uri) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+class MemoryCacheBackend(object):
+    """
+    In-memory LRU storage for ResponseCache entries.
+    """
+    def __init__(self, max_entries=500):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete_path(self, path):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == path]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class DiskCacheBackend(object):
+    """
+    Stores ResponseCache entries as json files - one directory per path, so entries can
+    survive process restarts and be shared between processes.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path_directory(self, path):
+        return os.path.join(self.directory, hashlib.sha1(path).hexdigest())
+
+    def _filename(self, key):
+        path, query = key
+        return os.path.join(self._path_directory(path), hashlib.sha1(query).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._filename(key), 'rb') as f:
+                entry = simplejson.load(f)
+        except (IOError, ValueError):
+            return None
+        entry['body'] = entry['body'].encode('utf-8')
+        return entry
+
+    def set(self, key, entry):
+        filename = self._filename(key)
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        # written aside and renamed so concurrent readers never see partial file
+        tmp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.current_thread().ident)
+        with open(tmp_filename, 'wb') as f:
+            simplejson.dump(dict(entry, body=entry['body'].decode('utf-8')), f)
+        os.rename(tmp_filename, filename)
+
+    def delete_path(self, path):
+        self._remove_files(self._path_directory(path))
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                self._remove_files(os.path.join(self.directory, name))
+
+    def _remove_files(self, directory):
+        if not os.path.isdir(directory):
+            return
+        for filename in os.listdir(directory):
+            try:
+                os.remove(os.path.join(directory, filename))
+            except OSError:
+                pass
+
+class ResponseCache(object):
+    """
+    Conditional GET cache: keeps response body with its ETag/Last-Modified validators
+    per path and query, so unchanged resources are served from cache on 304 responses.
+    Paths are prefixed with scope (Client.cache_scope - server and credentials), so one
+    cache can be shared by clients of different accounts.
+    """
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else MemoryCacheBackend()
+
+    def key(self, path, query, scope=''):
+        return (scope + path, urllib.urlencode(sorted(query.items())))
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, key, response, body):
+        etag, last_modified = response.getheader('etag'), response.getheader('last-modified')
+        if etag or last_modified:
+            self.backend.set(key, {'etag': etag, 'last_modified': last_modified, 'body': body})
+
+    def invalidate(self, path, scope=''):
+        self.backend.delete_path(scope + path)
+
+    def clear(self):
+        self.backend.clear()
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of keep-alive connections to single host. At most max_connections
+    are open at once - callers block until one of them is released, but no longer than
+    pool_timeout seconds (None waits forever) when PoolTimeout is raised.
+    """
+    # errors which on reused connection mean that server has closed it in the meantime -
+    # socket.timeout is not one of them (server may still be processing the request)
+    stale_connection_errors = (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error)
+    # requests which can be sent again when connection breaks after they were sent
+    idempotent_methods = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def __init__(self, host, connection_class=httplib.HTTPSConnection, max_connections=4, timeout=None,
+            pool_timeout=30.0):
+        self.host = host
+        self.connection_class = connection_class
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.pool_timeout = pool_timeout
+        self._idle = []
+        self._free_slots = max_connections
+        self._slot_released = threading.Condition(threading.Lock())
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(('requests', 'created', 'reused', 'reconnected', 'discarded'), 0)
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _connect(self):
+        self._count('created')
+        if self.timeout is None:
+            return self.connection_class(self.host)
+        return self.connection_class(self.host, timeout=self.timeout)
+
+    def acquire(self):
+        """
+        Returns (connection, reused) pair. Connection has to be given back with release().
+        """
+        self._acquire_slot()
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            return self._connect(), False
+        if self._dropped(connection):
+            connection.close()
+            return self._connect(), False
+        self._count('reused')
+        return connection, True
+
+    def _acquire_slot(self):
+        with self._slot_released:
+            if not self._free_slots:
+                deadline = time.time() + self.pool_timeout if self.pool_timeout is not None else None
+                while not self._free_slots:
+                    if deadline is None:
+                        self._slot_released.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        # e.g. all connections held by streamed lists which make nested requests
+                        raise PoolTimeout('No connection to %s released within %s s (max_connections=%d)'
+                                % (self.host, self.pool_timeout, self.max_connections))
+                    self._slot_released.wait(remaining)
+            self._free_slots -= 1
+
+    def _release_slot(self):
+        with self._slot_released:
+            if self._free_slots >= self.max_connections:
+                raise ValueError('Connection released too many times')
+            self._free_slots += 1
+            self._slot_released.notify()
+
+    def _dropped(self, connection):
+        # idle keep-alive socket becomes readable when server closes it
+        if connection.sock is None:
+            return False
+        try:
+            return bool(select.select([connection.sock], [], [], 0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def release(self, connection, reusable=True):
+        if reusable:
+            with self._lock:
+                self._idle.append(connection)
+        else:
+            self._count('discarded')
+            connection.close()
+        self._release_slot()
+
+    def request(self, method, url, body=None, headers=None, timings=None):
+        """
+        Sends request and returns (response, body) pair. Request which fails on reused
+        connection before it was sent (or idempotent one before any response arrived) is
+        repeated once on fresh one - timed out requests never are. When timings dict is given
+        connect_time, server_time (until response headers) and read_time are stored in it.
+        """
+        connection, response = self._open(method, url, body, headers, timings)
+        try:
+            started = time.time()
+            data = response.read()
+            if timings is not None:
+                timings['read_time'] = time.time() - started
+        except:
+            self.release(connection, reusable=False)
+            raise
+        self.release(connection, reusable=not response.will_close)
+        return response, data
+
+    def stream(self, method, url, body=None, headers=None, timings=None, chunk_size=64 * 1024):
+        """
+        Same as request() but returns (response, chunks) pair where chunks is generator reading
+        body piece by piece. Connection is given back when chunks is exhausted or closed.
+        """
+        connection, response = self._open(method, url, body, headers, timings)
+        return response, self._chunks(connection, response, chunk_size, timings)
+
+    def _open(self, method, url, body, headers, timings):
+        self._count('requests')
+        connection, reused = self.acquire()
+        try:
+            while True:
+                sent = False
+                try:
+                    started = time.time()
+                    if connection.sock is None:
+                        connection.connect()
+                    connected = time.time()
+                    connection.request(method, url, body, headers or {})
+                    sent = True
+                    response = connection.getresponse()
+                    break
+                except socket.timeout:
+                    raise
+                except self.stale_connection_errors:
+                    connection.close()
+                    # request which was sent may have been processed already
+                    if not reused or (sent and method not in self.idempotent_methods):
+                        raise
+                    self._count('reconnected')
+                    connection, reused = self._connect(), False
+        except:
+            self.release(connection, reusable=False)
+            raise
+        if timings is not None:
+            timings['connect_time'] = connected - started
+            timings['server_time'] = time.time() - connected
+        return connection, response
+
+    def _chunks(self, connection, response, chunk_size, timings):
+        # connection with unread body can't be reused
+        reusable = False
+        read_time = 0.0
+        try:
+            while True:
+                started = time.time()
+                chunk = response.read(chunk_size)
+                read_time += time.time() - started
+                if not chunk:
+                    break
+                yield chunk
+            reusable = not response.will_close
+        finally:
+            if timings is not None:
+                timings['read_time'] = read_time
+            self.release(connection, reusable=reusable)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, idle=len(self._idle))
+        return stats
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+class ContentDecoder(object):
+    """
+    Incremental decoder of gzip or deflate (Content-Encoding) compressed body.
+    """
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+        self._started = False
+
+    @classmethod
+    def for_response(cls, response):
+        """
+        Returns decoder for response body or None when it is not compressed.
+        """
+        encoding = (response.getheader('content-encoding') or '').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            return cls('gzip')
+        if encoding == 'deflate':
+            return cls('deflate')
+        return None
+
+    def decompress(self, data):
+        if not self._started and self.encoding == 'deflate' and data:
+            self._started = True
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                # some servers send raw deflate stream without zlib header
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return self._decompressor.flush()
+
+def gzip_compress(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+JSON_WHITESPACE = ' \t\n\r'
+
+def iter_json_array(chunks, decoder=simplejson.JSONDecoder()):
+    """
+    Incrementally decodes json array from iterable of utf-8 byte chunks and yields its
+    elements as soon as each of them is complete - only the element being decoded and
+    the last chunk are kept in memory.
+    """
+    chunks = iter(chunks)
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    state = {'buffer': u'', 'position': 0, 'eof': False}
+
+    def read(size):
+        # appends chunks until at least size characters are left to decode
+        buffer = state['buffer'][state['position']:]
+        while len(buffer) < size and not state['eof']:
+            chunk = next(chunks, None)
+            if chunk is None:
+                state['eof'] = True
+                buffer += text_decoder.decode('', True)
+            else:
+                buffer += text_decoder.decode(chunk)
+        state['buffer'], state['position'] = buffer, 0
+
+    def next_char():
+        # returns next non whitespace character (None at the end of input) without consuming it
+        while True:
+            buffer, position = state['buffer'], state['position']
+            while position < len(buffer) and buffer[position] in JSON_WHITESPACE:
+                position += 1
+            state['position'] = position
+            if position < len(buffer):
+                return buffer[position]
+            if state['eof']:
+                return None
+            read(1)
+
+    def error(message):
+        return ValueError('%s at character %d of json array' % (message, state['position']))
+
+    try:
+        if next_char() != u'[':
+            raise error('Expecting [')
+        state['position'] += 1
+        if next_char() == u']':
+            state['position'] += 1
+        else:
+            while True:
+                while True:
+                    try:
+                        value, end = decoder.raw_decode(state['buffer'], state['position'])
+                    except ValueError:
+                        if state['eof']:
+                            raise
+                        value, end = None, None
+                    # value is complete only when followed by separator - numbers split between
+                    # chunks (like "0" + ".5" or "1" + "e5") decode too early otherwise
+                    if end is not None:
+                        buffer, rest = state['buffer'], end
+                        while rest < len(buffer) and buffer[rest] in JSON_WHITESPACE:
+                            rest += 1
+                        if (rest < len(buffer) and buffer[rest] in u',]') or state['eof']:
+                            break
+                    # grow buffer geometrically so long elements are not re-decoded for every chunk
+                    read(max(2 * (len(state['buffer']) - state['position']), 1))
+                state['position'] = end
+                yield value
+                separator = next_char()
+                state['position'] += 1
+                if separator == u']':
+                    break
+                if separator != u',':
+                    state['position'] -= 1
+                    raise error('Expecting , or ]')
+        if next_char() is not None:
+            raise error('Extra data')
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+class Future(object):
+    """
+    Result of call scheduled on WorkerPool. result() blocks until call has finished and
+    returns its value or re-raises its exception.
+    """
+    def __init__(self):
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def _finish(self, result=None, exc_info=None):
+        with self._lock:
+            self._result, self._exc_info = result, exc_info
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        return self._finished.is_set()
+
+    def result(self):
+        self._finished.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        self._finished.wait()
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def add_done_callback(self, callback):
+        """
+        Callback is called with this future as the only argument (in worker thread).
+        """
+        with self._lock:
+            if not self._finished.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+class WorkerPool(object):
+    """
+    Fixed size pool of daemon threads executing submitted calls. Threads are started on demand.
+    """
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self._tasks = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            future, fn, args, kwargs = task
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                future._finish(exc_info=sys.exc_info())
+            else:
+                future._finish(result)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self._tasks.put((future, fn, args, kwargs))
+        with self._lock:
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return future
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            self._tasks.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return urllib.quote(str(value), safe='~')
+
+class SigningContext(object):
+    """
+    OAuth HMAC-SHA1 signer for one consumer and token pair. HMAC key, static oauth parameters
+    and normalized urls are prepared once, so signing request only hashes its base string.
+    """
+    max_cached_urls = 1024
+
+    def __init__(self, consumer, token, protocol, domain):
+        self._hmac = hmac.new('%s&%s' % (_escape(consumer.secret), _escape(token.secret)), digestmod=hashlib.sha1)
+        self._oauth_parameters = [
+            ('oauth_consumer_key', _escape(consumer.key)),
+            ('oauth_signature_method', 'HMAC-SHA1'),
+            ('oauth_token', _escape(token.key)),
+            ('oauth_version', '1.0'),
+        ]
+        # default ports are not part of normalized url
+        default_port = {'http': ':80', 'https': ':443'}.get(protocol)
+        if default_port and domain.endswith(default_port):
+            domain = domain[:-len(default_port)]
+        self._base_url = '%s://%s' % (protocol, domain)
+        self._urls = {}
+
+    def _normalized_url(self, path):
+        try:
+            return self._urls[path]
+        except KeyError:
+            if len(self._urls) >= self.max_cached_urls:
+                self._urls.clear()
+            url = self._urls[path] = _escape(self._base_url + path)
+            return url
+
+    def authorization(self, method, path, query=None, nonce=None, timestamp=None):
+        """
+        Returns Authorization header value for request - query parameters are signed too.
+        """
+        oauth_parameters = self._oauth_parameters + [
+            ('oauth_nonce', nonce or str(random.getrandbits(64))),
+            ('oauth_timestamp', str(timestamp or int(time.time()))),
+        ]
+        parameters = oauth_parameters + [(_escape(k), _escape(v)) for k, v in (query or {}).iteritems()]
+        parameters.sort()
+        base_string = '%s&%s&%s' % (method, self._normalized_url(path),
+                _escape('&'.join(['%s=%s' % parameter for parameter in parameters])))
+        hashed = self._hmac.copy()
+        hashed.update(base_string)
+        oauth_parameters.append(('oauth_signature', _escape(binascii.b2a_base64(hashed.digest())[:-1])))
+        return 'OAuth realm=""' + ''.join([', %s="%s"' % parameter for parameter in oauth_parameters])
+
+class LatencyHistogram(object):
+    """
+    Histogram with geometric buckets (about 10% wide) - percentiles are approximated
+    by bucket upper bounds so memory use doesn't depend on number of samples.
+    """
+    base = 0.0001
+    factor = 1.1
+
+    def __init__(self):
+        self.buckets = collections.defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        bucket = int(math.log(value / self.base, self.factor)) + 1 if value > self.base else 0
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.base * self.factor ** bucket, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+class MetricsAggregator(object):
+    """
+    Client hook which keeps request counters and latency histograms (in seconds) for
+    every timing found in emitted records. Use attach(client) to register it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = collections.defaultdict(int)
+            self.histograms = collections.defaultdict(LatencyHistogram)
+
+    def attach(self, client):
+        for event in Client.events:
+            client.add_hook(event, self)
+        return self
+
+    def __call__(self, event, record):
+        with self._lock:
+            self.counters[event] += 1
+            if event == 'request':
+                self.counters['request.%s' % record['method']] += 1
+                self.counters['status.%s' % record['status']] += 1
+                for key in ('bytes_in', 'bytes_out', 'content_bytes_in', 'content_bytes_out'):
+                    self.counters[key] += record.get(key, 0)
+            elif event == 'build':
+                self.counters['objects_built'] += record['objects']
+            for key, value in record.iteritems():
+                if key.endswith('_time') and value is not None:
+                    self.histograms[key[:-5]].add(value)
+
+    def dump(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'latency': dict((name, histogram.summary()) for name, histogram in self.histograms.items()),
+            }
+
+    def format(self):
+        """
+        Returns metrics as plain text lines (name value) ready to be scraped.
+        """
+        metrics = self.dump()
+        lines = ['invoicible_%s %s' % (name.replace('.', '_'), value)
+                for name, value in sorted(metrics['counters'].items())]
+        for name, summary in sorted(metrics['latency'].items()):
+            for key in ('count', 'mean', 'p50', 'p95', 'p99', 'max'):
+                lines.append('invoicible_%s_seconds_%s %s' % (name, key, summary[key]))
+        return '\n'.join(lines)
+
 class Client(oauth.OAuthClient):
+    events = ('request', 'retry', 'cache_hit', 'build')
+    # requests with these methods are repeated when server responds with one of retry_statuses
+    idempotent_methods = ('GET', 'PUT', 'DELETE')
+    retry_statuses = (THROTTLED,)
+    accept_encoding = 'gzip, deflate'
+    connection_classes = {'http': httplib.HTTPConnection, 'https': httplib.HTTPSConnection}
+    # shorter request bodies are sent uncompressed even with compress_requests
+    compress_min_size = 512
+
     def __init__(self, consumer_key, consumer_secret,
                 access_token_key, access_token_secret,
-                invoicible_domain='secure.centrumfaktur.pl'):
+                invoicible_domain='secure.centrumfaktur.pl',
+                identity_map_size=1000, identity_map_ttl=None,
+                max_connections=4, timeout=None, pool_timeout=30.0, response_cache=None,
+                rate_limiter=None, max_retries=3, backoff=0.5, max_backoff=30.0,
+                compress_requests=False, protocol='https'):
         self.consumer = oauth.OAuthConsumer(consumer_key, consumer_secret)
         self.access_token = oauth.OAuthToken(access_token_key, access_token_secret)
         self.invoicible_domain = invoicible_domain
+        self.identity_map = IdentityMap(identity_map_size, identity_map_ttl)
+        self.response_cache = response_cache
+        # responses are cached per account - same paths of other accounts have different content
+        self.cache_scope = '%s://%s %s %s ' % (protocol, invoicible_domain, consumer_key, access_token_key)
 
-        self.connection = httplib.HTTPSConnection(self.invoicible_domain)
-        self.protocol = 'https'
+        self.protocol = protocol
+        self.pool = ConnectionPool(self.invoicible_domain, connection_class=self.connection_classes[protocol],
+                max_connections=max_connections, timeout=timeout, pool_timeout=pool_timeout)
+        self.signer = SigningContext(self.consumer, self.access_token, self.protocol, self.invoicible_domain)
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.compress_requests = compress_requests
 
-        self.signature_method_hmac_sha1 = oauth.OAuthSignatureMethod_HMAC_SHA1()
         self.json_encoder = simplejson.JSONEncoder()
+        self.hooks = {}
+        self._request_ids = itertools.count(1)
+        self._local = threading.local()
+
+    def add_hook(self, event, callback):
+        """
+        Registers callback(event, record) called for every event (one of Client.events).
+        Records are dicts - timings are stored under *_time keys (in seconds), bytes_in/bytes_out
+        are sizes of (possibly compressed) bodies on the wire and content_bytes_in/content_bytes_out
+        sizes before compression.
+        """
+        if event not in self.events:
+            raise ValueError('Unknown event: %s' % event)
+        self.hooks.setdefault(event, []).append(callback)
+
+    def remove_hook(self, event, callback):
+        self.hooks.get(event, []).remove(callback)
+
+    def emit(self, event, record):
+        for callback in self.hooks.get(event, ()):
+            callback(event, record)
+
+    @property
+    def last_request_id(self):
+        """
+        Id of the last request record emitted in current thread.
+        """
+        return getattr(self._local, 'request_id', None)
+
+    def get_object(self, api_klass, resource_uri):
+        """
+        Returns api_klass instance for resource_uri fetching it only when it's not in identity map yet.
+        """
+        api_object = self.identity_map.get(resource_uri)
+        if api_object is None or not isinstance(api_object, api_klass):
+            api_object = api_klass(self, resource_uri=resource_uri)
+            self.identity_map.set(resource_uri, api_object)
+        return api_object
+
+    def _sign(self, method, path, query=None):
+        return {'Authorization': self.signer.authorization(method, path, query)}
+
+    def _error(self, response, body, default):
+        error_klass = compatible_error(STATUS_ERRORS.get(response.status, default), default)
+        kwargs = {'status': response.status, 'body': body}
+        if issubclass(error_klass, Throttled):
+            kwargs['retry_after'] = parse_retry_after(response.getheader('retry-after'))
+        return error_klass('%s %s' % (response.status, response.reason), **kwargs)
+
+    def _backoff_delay(self, attempt, retry_after=None):
+        # exponential backoff with "equal jitter" - but never shorter than server asked for
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        return max(delay, retry_after or 0)
+
+    def _request(self, method, path, query=None, body=None, headers=None, ok=(200,), error=ValidationError,
+            decode=None, stream=False):
+        """
+        Sends request (signed again on every attempt) and returns (response, value) pair where
+        value is body processed by decode(response, body) (json decoding by default).
+        Statuses other than ok are raised as InvoicibleApiError subclasses - idempotent
+        requests are repeated with backoff first when status is one of retry_statuses.
+        With stream=True decode gets generator of body chunks instead of body - request
+        record is emitted once the body is consumed. Compressed responses are decoded before
+        they get to decode.
+        """
+        url = path + '?' + urllib.urlencode(query) if query else path
+        headers = dict(headers or {})
+        if self.accept_encoding:
+            headers.setdefault('Accept-Encoding', self.accept_encoding)
+        content_length = len(body or '')
+        if body and self.compress_requests and content_length >= self.compress_min_size:
+            body = gzip_compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            started = time.time()
+            request_headers = self._sign(method, path, query)
+            request_headers.update(headers)
+            record = {
+                'id': next(self._request_ids), 'method': method, 'path': path, 'attempt': attempt,
+                'status': None, 'bytes_out': len(body or ''), 'bytes_in': 0,
+                'content_bytes_out': content_length, 'content_bytes_in': 0,
+                'sign_time': time.time() - started, 'decode_time': None,
+            }
+            self._local.request_id = record['id']
+            try:
+                if stream:
+                    response, chunks = self.pool.stream(method, url, body, request_headers, timings=record)
+                    data = None if response.status in ok else ''.join(chunks)
+                else:
+                    response, data = self.pool.request(method, url, body, request_headers, timings=record)
+            except Exception, e:
+                record.update(error=e, total_time=time.time() - started)
+                self.emit('request', record)
+                raise
+            content_decoder = ContentDecoder.for_response(response)
+            if data is None:
+                record['status'] = response.status
+                if self.rate_limiter is not None:
+                    self.rate_limiter.on_success()
+                return response, decode(response, self._streamed(chunks, content_decoder, record, started))
+            record.update(status=response.status, bytes_in=len(data))
+            record['network_time'] = record['connect_time'] + record['server_time'] + record['read_time']
+            if content_decoder is not None:
+                inflating_started = time.time()
+                data = content_decoder.decompress(data) + content_decoder.flush()
+                record['inflate_time'] = time.time() - inflating_started
+            record['content_bytes_in'] = len(data)
+            if response.status in ok:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.on_success()
+                decoding_started = time.time()
+                try:
+                    value = decode(response, data) if decode is not None else simplejson.loads(data)
+                finally:
+                    record['decode_time'] = time.time() - decoding_started
+                    record['total_time'] = time.time() - started
+                    self.emit('request', record)
+                return response, value
+            record['total_time'] = time.time() - started
+            self.emit('request', record)
+            exception = self._error(response, data, error)
+            retry_after = getattr(exception, 'retry_after', None)
+            if self.rate_limiter is not None and isinstance(exception, Throttled):
+                self.rate_limiter.on_throttled(retry_after)
+            if method not in self.idempotent_methods or response.status not in self.retry_statuses \
+              or attempt >= self.max_retries:
+                raise exception
+            delay = self._backoff_delay(attempt, retry_after)
+            self.emit('retry', {'method': method, 'path': path, 'status': response.status,
+                'attempt': attempt, 'delay': delay})
+            time.sleep(delay)
+            attempt += 1
+
+    def _streamed(self, chunks, content_decoder, record, started):
+        try:
+            for chunk in chunks:
+                record['bytes_in'] += len(chunk)
+                if content_decoder is not None:
+                    chunk = content_decoder.decompress(chunk)
+                record['content_bytes_in'] += len(chunk)
+                yield chunk
+            if content_decoder is not None:
+                chunk = content_decoder.flush()
+                record['content_bytes_in'] += len(chunk)
+                yield chunk
+        finally:
+            chunks.close()
+            record['network_time'] = record['connect_time'] + record['server_time'] + record.get('read_time', 0)
+            record['total_time'] = time.time() - started
+            self.emit('request', record)
+
+    def iter_resources(self, path, query=None):
+        """
+        Yields resources of json list decoding them one by one while the response body is
+        read. Request is sent (and pooled connection taken) only when the first resource is
+        requested and connection is given back when iteration ends or iterator is closed.
+        Requests made while iterating (like accessing related objects) need another pooled
+        connection - with all of them held they fail with PoolTimeout.
+        Cached responses are stored as a whole, so with response_cache it falls back to
+        get_resources().
+        """
+        if self.response_cache is not None:
+            resources = self.get_resources(path, query)
+        else:
+            response, resources = self._request('GET', path, dict(query or {}, format='json'),
+                error=DoesNotExists,
+                decode=lambda response, chunks: iter_json_array(chunks),
+                stream=True,
+            )
+        for resource in resources:
+            yield resource
 
     def get_resources(self, path, query=None):
         query = query or {}
         query['format'] = 'json'
-        oauth_request = oauth.OAuthRequest.from_consumer_and_token(
-            self.consumer,
-            token=self.access_token,
-            http_method="GET",
-            http_url=urlparse.urlunparse((self.protocol, self.invoicible_domain, path, None, None, None)),
-            parameters = query,
-        )
-        oauth_request.sign_request(self.signature_method_hmac_sha1, self.consumer, self.access_token)
-        self.connection.request('GET',
-            path + '?' + urllib.urlencode(query),
-            headers=oauth_request.to_header()
+        headers = {}
+        cache_key = cached = None
+        if self.response_cache is not None:
+            cache_key = self.response_cache.key(path, query, self.cache_scope)
+            cached = self.response_cache.get(cache_key)
+            if cached:
+                headers.update(self.response_cache.conditional_headers(cached))
+
+        def decode(response, json):
+            if response.status == NOT_MODIFIED:
+                self.emit('cache_hit', {'path': path, 'query': query, 'bytes': len(cached['body'])})
+                json = cached['body']
+            elif cache_key is not None:
+                self.response_cache.store(cache_key, response, json)
+            return simplejson.loads(json)
+
+        response, resources = self._request('GET', path, query,
+            headers=headers,
+            ok=(200, NOT_MODIFIED) if cached else (200,),
+            error=DoesNotExists,
+            decode=decode,
         )
-        response = self.connection.getresponse()
-        json = response.read()
-        if response.status != 200:
-            raise DoesNotExists()
-        return simplejson.loads(json)
+        return resources
+
+    def invalidate(self, path):
+        """
+        Drops cached data for path and for collection which contains it.
+        """
+        self.identity_map.invalidate(path)
+        if self.response_cache is not None:
+            self.response_cache.invalidate(path, self.cache_scope)
+            self.response_cache.invalidate(path.rstrip('/').rsplit('/', 1)[0] + '/', self.cache_scope)
 
     def create_resource(self, path, data):
-        query = 'format=json'
-        oauth_request = oauth.OAuthRequest.from_consumer_and_token(
-            self.consumer,
-            token=self.access_token,
-            http_method="POST",
-            http_url=urlparse.urlunparse((self.protocol, self.invoicible_domain, path, query, None, None))
-        )
-        oauth_request.sign_request(self.signature_method_hmac_sha1, self.consumer, self.access_token)
-        data = self.json_encoder.encode(data)
-        headers = oauth_request.to_header()
-        headers['Content-Type'] = 'application/json'
-        headers['Accept'] = 'application/json'
-        self.connection.request('POST',
+        response, resource = self._request('POST',
             path,
-            body=data,
-            headers=headers
+            {'format': 'json'},
+            body=self.json_encoder.encode(data),
+            headers={'Content-Type': 'application/json', 'Accept': 'application/json'},
         )
-        response = self.connection.getresponse()
-        json = response.read()
-        #print json
-        if response.status != 200:
-            raise ValidationError(response)
-        return simplejson.loads(json)
+        self.invalidate(path)
+        return resource
 
     def update_resource(self, path, data):
-        query = 'format=json'
-        oauth_request = oauth.OAuthRequest.from_consumer_and_token(
-            self.consumer,
-            token=self.access_token,
-            http_method="PUT",
-            http_url=urlparse.urlunparse((self.protocol, self.invoicible_domain, path, query, None, None))
-        )
-        oauth_request.sign_request(self.signature_method_hmac_sha1, self.consumer, self.access_token)
-        data = self.json_encoder.encode(data)
-        headers = oauth_request.to_header()
-        headers['Content-Type'] = 'application/json'
-        self.connection.request('PUT',
+        response, resource = self._request('PUT',
             path,
-            body=data,
-            headers=headers
+            {'format': 'json'},
+            body=self.json_encoder.encode(data),
+            headers={'Content-Type': 'application/json'},
         )
-        response = self.connection.getresponse()
-        return simplejson.loads(response.read())
+        self.invalidate(path)
+        return resource
 
     def delete_resource(self, path):
-        query = 'format=json'
-        oauth_request = oauth.OAuthRequest.from_consumer_and_token(
-            self.consumer,
-            token=self.access_token,
-            http_method="DELETE",
-            http_url=urlparse.urlunparse((self.protocol, self.invoicible_domain, path, query, None, None))
-        )
-        oauth_request.sign_request(self.signature_method_hmac_sha1, self.consumer, self.access_token)
-        self.connection.request('DELETE',
+        response, body = self._request('DELETE',
             path,
-            headers=oauth_request.to_header()
+            {'format': 'json'},
+            ok=(200, 202, DELETED),
+            error=DoesNotExists,
+            decode=lambda response, body: body,
         )
-        response = self.connection.getresponse()
+        self.invalidate(path)
         return response.status == DELETED
 
+class AsyncClient(Client):
+    """
+    Client which additionally runs requests on worker threads. *_async methods return Future
+    instances immediately, so many requests can be in flight at once. Errors
+    (DoesNotExists, ValidationError) are re-raised by Future.result().
+    """
+    def __init__(self, *args, **kwargs):
+        max_workers = kwargs.pop('max_workers', 16)
+        kwargs.setdefault('max_connections', max_workers)
+        Client.__init__(self, *args, **kwargs)
+        self.workers = WorkerPool(max_workers)
+
+    def submit(self, fn, *args, **kwargs):
+        return self.workers.submit(fn, *args, **kwargs)
+
+    def get_resources_async(self, path, query=None):
+        return self.submit(self.get_resources, path, query)
+
+    def create_resource_async(self, path, data):
+        return self.submit(self.create_resource, path, data)
+
+    def update_resource_async(self, path, data):
+        return self.submit(self.update_resource, path, data)
+
+    def delete_resource_async(self, path):
+        return self.submit(self.delete_resource, path)
+
+    def close(self):
+        self.workers.shutdown()
+        self.pool.close()
+
+def _submit(client, fn, *args, **kwargs):
+    if not hasattr(client, 'submit'):
+        raise Exception("Asynchronous calls require AsyncClient instance.")
+    return client.submit(fn, *args, **kwargs)
+
 class InvoicibleApiFieldDescriptor(object):
-    def __init__(self, prepopulate_from, klass):
+    def __init__(self, prepopulate_from, klass, manager_klass=None):
         self.prepopulate_from = prepopulate_from
         self.klass = klass
+        # used by prefetch_related to load whole collection when it's cheaper
+        self.manager_klass = manager_klass
         self.name = '_' + prepopulate_from[:-4]
 
     def __get__(self, api_object, api_class):
-        resource = api_object._client.get_resources(getattr(api_object, self.prepopulate_from))
-        if not api_object.__dict__.get(self.name, None):
-            resource = api_object._client.get_resources(getattr(api_object, self.prepopulate_from))
-            api_object.__dict__[self.name] = self.klass(api_object._client, resource)
-        return api_object.__dict__[self.name]
+        if api_object is None:
+            return self
+        resource_uri = getattr(api_object, self.prepopulate_from)
+        related = getattr(api_object, self.name, None)
+        if related is None or related.resource_uri != resource_uri:
+            related = api_object._client.get_object(self.klass, resource_uri)
+            setattr(api_object, self.name, related)
+        return related
 
     def __set__(self, api_object, value):
         if not hasattr(api_object, 'resource_uri') or not getattr(api_object, 'resource_uri', None) \
           or not isinstance(value, self.klass):
             raise Exception("You can assign only saved %s instances." % self.klass.__name__)
         setattr(api_object, self.prepopulate_from, value.resource_uri)
-        api_object.__dict__[self.name] = value
+        setattr(api_object, self.name, value)
 
 class InvoicibleApiManagerFieldDescriptor(object):
     def __init__(self, prepopulate_from, manager_klass):
@@ -152,63 +1213,256 @@ class InvoicibleApiManagerFieldDescriptor(object):
         self.name = '_' + prepopulate_from[:-4]
 
     def __get__(self, api_object, api_class):
-        if not api_object.__dict__.get(self.name, None):
+        if api_object is None:
+            return self
+        manager = getattr(api_object, self.name, None)
+        if manager is None:
             resources_uri = getattr(api_object, self.prepopulate_from)
             manager = self.manager_klass(invoicible_client=api_object._client, resources_uri=resources_uri)
-            api_object.__dict__[self.name] = manager
-        return api_object.__dict__[self.name]
+            setattr(api_object, self.name, manager)
+        return manager
 
     def __set__(self, api_object, value):
         raise Exception("""You can't assign to this field: You can only iterate through it's content by all() method
 and create items with create() method""")
 
+# parsed values of recently seen date strings - list pages repeat the same dates a lot.
+# Every format has its own memo, so one can't return value which the other would reject
+DATE_MEMO_SIZE = 4096
+_date_memo = {}
+_datetime_memo = {}
+
+def _memoize_date(memo, value, result):
+    if len(memo) >= DATE_MEMO_SIZE:
+        memo.clear()
+    memo[value] = result
+    return result
+
+def parse_date(value):
+    """
+    Fixed format (DATE_FORMAT) replacement of strptime which returns datetime.date.
+    """
+    try:
+        return _date_memo[value]
+    except (KeyError, TypeError):
+        pass
+    if len(value) != 10 or value[4] != '-' or value[7] != '-' \
+      or not (value[:4] + value[5:7] + value[8:]).isdigit():
+        raise ValueError("time data %r does not match format %r" % (value, DATE_FORMAT))
+    return _memoize_date(_date_memo, value, datetime.date(int(value[:4]), int(value[5:7]), int(value[8:])))
+
+def parse_datetime(value):
+    """
+    Fixed format (DATETIME_FORMAT) replacement of strptime.
+    """
+    try:
+        return _datetime_memo[value]
+    except (KeyError, TypeError):
+        pass
+    if len(value) != 19 or value[4] != '-' or value[7] != '-' or value[10] != ' ' \
+      or value[13] != ':' or value[16] != ':' \
+      or not (value[:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:]).isdigit():
+        raise ValueError("time data %r does not match format %r" % (value, DATETIME_FORMAT))
+    return _memoize_date(_datetime_memo, value, datetime.datetime(int(value[:4]), int(value[5:7]), int(value[8:10]),
+            int(value[11:13]), int(value[14:16]), int(value[17:])))
+
+def format_date(value):
+    return '%04d-%02d-%02d' % (value.year, value.month, value.day)
+
+def format_datetime(value):
+    return '%04d-%02d-%02d %02d:%02d:%02d' % (value.year, value.month, value.day,
+            value.hour, value.minute, value.second)
+
+def _field_decoder(t):
+    if t is datetime.datetime:
+        return parse_datetime
+    elif t is datetime.date:
+        return parse_date
+    elif issubclass(t, list) and hasattr(t, 'item_klass'):
+        decode_item = t.item_klass.from_json
+        return lambda value: [decode_item(item) for item in value]
+    return t
+
+def _field_encoder(t):
+    if t is datetime.datetime:
+        return format_datetime
+    elif t is datetime.date:
+        return format_date
+    elif issubclass(t, list) and hasattr(t, 'item_klass'):
+        return lambda value: [item.get_json() for item in value]
+    return None
+
+class CompiledFieldsMeta(type):
+    """
+    Compiles _fields table once per class: decoders and encoders are resolved up front
+    (so parsing doesn't inspect field types per object) and fields together with
+    related object caches become __slots__ of the instances.
+    """
+    def __new__(meta, name, bases, attrs):
+        fields = attrs.get('_fields')
+        if fields is not None and '__slots__' not in attrs:
+            slotted = set()
+            for base in bases:
+                for klass in base.__mro__:
+                    slotted.update(klass.__dict__.get('__slots__', ()))
+            slots = set(fields)
+            slots.update(value.name for value in attrs.values()
+                    if isinstance(value, (InvoicibleApiFieldDescriptor, InvoicibleApiManagerFieldDescriptor)))
+            attrs['__slots__'] = tuple(sorted(slots - slotted))
+        klass = type.__new__(meta, name, bases, attrs)
+        if fields is not None:
+            klass._decoders = tuple((f, _field_decoder(t)) for f, t in sorted(fields.items()))
+            klass._encoders = tuple((f, _field_encoder(t)) for f, t in sorted(fields.items()))
+            klass._decoder_map = dict(klass._decoders)
+            klass._encoder_map = dict(klass._encoders)
+            # values which can be changed in place - they are compared with received json on save
+            klass._mutable_fields = frozenset(f for f, t in fields.items() if issubclass(t, list))
+        return klass
+
+# api objects are shared between threads (identity map, worker pools) - lazy fields are
+# decoded under this lock so only one thread decodes and stores each of them
+_lazy_decode_lock = threading.Lock()
+
 class InvoicibleApiObject(object):
+    __metaclass__ = CompiledFieldsMeta
+    __slots__ = ('_client', 'resource_uri', '_raw', '_dirty', '_pristine')
     _resources_uri = None
     _fields = {}
 
-    def __init__(self, invoicible_client=None, resource_uri=None, json=None, **kwargs):
-        self._client = invoicible_client
+    def __init__(self, invoicible_client=None, resource_uri=None, json=None, lazy=False, **kwargs):
+        object.__setattr__(self, '_raw', None)
+        object.__setattr__(self, '_dirty', None)
+        object.__setattr__(self, '_pristine', None)
+        object.__setattr__(self, '_client', invoicible_client)
+        object.__setattr__(self, 'resource_uri', resource_uri or None)
         if resource_uri:
-            self.resource_uri = resource_uri
             json = self._client.get_resources(self.resource_uri)
-        else:
-            self.resource_uri = None
 
         if json:
-            self.parse_json(json)
+            if lazy:
+                self._load_lazy(json, fresh=True)
+            else:
+                self.parse_json(json)
+
+    def __getattr__(self, name):
+        # called only for fields which are not set yet - in lazy mode they are decoded on first access
+        raw = object.__getattribute__(self, '_raw') if name != '_raw' else None
+        if raw is None or name not in self._decoder_map:
+            raise AttributeError(name)
+        if name not in raw:
+            # raises AttributeError unless another thread has just decoded it
+            return object.__getattribute__(self, name)
+        with _lazy_decode_lock:
+            try:
+                # decoded by another thread in the meantime
+                return object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+            if name not in raw:
+                raise AttributeError(name)
+            try:
+                value = self._decoder_map[name](raw[name])
+            except Exception, e:
+                raise ValidationError('Incorrect type for %s: %s (%s)' % ( self.__class__.__name__, name, e))
+            if name in self._mutable_fields:
+                self._remember(name, raw[name])
+            object.__setattr__(self, name, value)
+            raw.pop(name, None)
+        return value
+
+    def __setattr__(self, name, value):
+        try:
+            raw = object.__getattribute__(self, '_raw')
+        except AttributeError:
+            raw = None
+        if raw is not None:
+            raw.pop(name, None)
+        if name in self._decoder_map:
+            dirty = getattr(self, '_dirty', None)
+            if dirty is None:
+                dirty = set()
+                object.__setattr__(self, '_dirty', dirty)
+            dirty.add(name)
+        object.__setattr__(self, name, value)
+
+    def _remember(self, f, json_value):
+        pristine = getattr(self, '_pristine', None)
+        if pristine is None:
+            pristine = {}
+            object.__setattr__(self, '_pristine', pristine)
+        pristine[f] = json_value
+
+    def _forget(self, fields):
+        dirty, pristine = getattr(self, '_dirty', None), getattr(self, '_pristine', None)
+        if dirty:
+            dirty.difference_update(fields)
+        if pristine:
+            for f in fields:
+                pristine.pop(f, None)
 
     def get_json(self):
         data = {}
-        for f, t in self._fields.items():
-            # getting field value
+        raw = getattr(self, '_raw', None)
+        for f, encode in self._encoders:
+            if raw is not None and f in raw:
+                try:
+                    # not decoded yet so can be passed through as it is
+                    data[f] = raw[f]
+                    continue
+                except KeyError:
+                    # decoded by another thread in the meantime
+                    pass
             try:
                 field = getattr(self, f)
             except AttributeError:
                 # maybe if it's required field it should raise an exception?
-                break
-            if t is datetime.datetime:
-                data[f] = field.strftime(DATETIME_FORMAT)
-            elif t is datetime.date:
-                data[f] = field.strftime(DATE_FORMAT)
-            elif t is ItemList:
-                data[f] = map(lambda item: item.get_json(), field)
-            elif not isinstance(field, InvoicibleApiObject) \
-              and (not isinstance(field, type) or not issubclass(field, InvoicibleApiObject)):
-                data[f] = field
+                continue
+            data[f] = encode(field) if encode is not None else field
         return data
 
-    def parse_json(self, data, raw_json = False):
+    def parse_json(self, data, raw_json = False, lazy=False):
         if raw_json:
             data = simplejson.loads(data)
-        data = self._parse_json(data)
-        for f in data.keys():
-            setattr(self, f, data[f])
+        if lazy:
+            self._load_lazy(data)
+            return
+        if getattr(self, '_raw', None) is not None:
+            # fields which weren't accessed yet are decoded together with the new ones
+            data, raw = dict(self._raw), data
+            data.update(raw)
+            object.__setattr__(self, '_raw', None)
+        parsed = self._parse_json(data)
+        for f, value in parsed.iteritems():
+            object.__setattr__(self, f, value)
+        self._forget(parsed)
+        for f in self._mutable_fields:
+            if f in parsed:
+                self._remember(f, data[f])
+
+    def _load_lazy(self, data, fresh=False):
+        """
+        Keeps (copy of) decoded json and leaves field conversion for the first access.
+        """
+        if not isinstance(data, dict):
+            raise ValidationError(u'Incorrect data type, expected dict, received: %s.' % type(data))
+        # fields already set would shadow new values - fresh object has only resource_uri set
+        for f in (('resource_uri',) if fresh else self._decoder_map):
+            if f in data and f in self._decoder_map:
+                try:
+                    object.__delattr__(self, f)
+                except AttributeError:
+                    pass
+        if not fresh:
+            self._forget(data)
+        raw = dict(getattr(self, '_raw', None) or {})
+        raw.update(data)
+        object.__setattr__(self, '_raw', raw)
 
     def _parse_json(self, data):
-        d = {}
         if not isinstance(data, dict):
             raise ValidationError(u'Incorrect data type, expected dict, received: %s.' % type(data))
-        for f, t in self._fields.items():
+        d = {}
+        for f, decode in self._decoders:
             try:
                 field = data[f]
             except KeyError:
@@ -216,17 +1470,9 @@ class InvoicibleApiObject(object):
                     print 'missing key', f
                 continue
             try:
-                if t is datetime.datetime:
-                    value = datetime.datetime.strptime(field, DATETIME_FORMAT)
-                elif t is datetime.date:
-                    value = datetime.datetime.strptime(field, DATE_FORMAT)
-                elif issubclass(t, list) and hasattr(t, 'item_klass'):
-                    value = map(lambda item: t.item_klass(**item), field)
-                else:
-                    value = t(field)
+                d[f] = decode(field)
             except Exception, e:
                 raise ValidationError('Incorrect type for %s: %s (%s)' % ( self.__class__.__name__, f, e))
-            d[f] = value
         return d
 
     def delete(self):
@@ -234,16 +1480,64 @@ class InvoicibleApiObject(object):
             raise Exception("Can delete object without resource_uri assigned.")
         resource = self._client.delete_resource(self.resource_uri)
 
+    def get_changes(self):
+        """
+        Returns json of fields assigned since object was loaded (or saved) together with
+        item lists which were modified in place.
+        """
+        data = {}
+        dirty, pristine = getattr(self, '_dirty', None) or (), getattr(self, '_pristine', None) or {}
+        for f, encode in self._encoders:
+            if f not in dirty and f not in pristine:
+                continue
+            try:
+                field = getattr(self, f)
+            except AttributeError:
+                continue
+            value = encode(field) if encode is not None else field
+            if f in dirty or value != self._normalize(f, pristine[f]):
+                data[f] = value
+        return data
+
+    def _normalize(self, f, json_value):
+        encode = self._encoder_map[f]
+        value = self._decoder_map[f](json_value)
+        return encode(value) if encode is not None else value
+
+    def _mark_clean(self):
+        object.__setattr__(self, '_dirty', None)
+        raw = getattr(self, '_raw', None) or {}
+        for f, encode in self._encoders:
+            if f in self._mutable_fields and f not in raw:
+                try:
+                    self._remember(f, encode(getattr(self, f)))
+                except AttributeError:
+                    pass
+
     def save(self):
+        """
+        Creates object or sends fields modified since it was loaded - request is skipped
+        when nothing has changed. Response is decoded lazily.
+        """
         if self.resource_uri:
-            data = self._client.update_resource(self.resource_uri, self.get_json())
+            changes = self.get_changes()
+            if not changes:
+                return
+            data = self._client.update_resource(self.resource_uri, changes)
         else:
             if not hasattr(self, '_resources_uri') or not self._resources_uri:
                 raise Exception(
                     "This object can't be saved it doesn't contains resources_uri! How did you get it??"
                 )
             data = self._client.create_resource(self._resources_uri, self.get_json())
-        self.parse_json(data)
+        self._mark_clean()
+        self.parse_json(data, lazy=True)
+
+    def delete_async(self):
+        return _submit(self._client, self.delete)
+
+    def save_async(self):
+        return _submit(self._client, self.save)
 
     def __str__(self):
         return str(self.get_json())
@@ -251,43 +1545,416 @@ class InvoicibleApiObject(object):
     def __repr__(self):
         return str(self.get_json())
 
+class BulkResult(object):
+    """
+    Outcome of single bulk operation entry: value is set on success, error otherwise.
+    """
+    def __init__(self, index, item, value=None, error=None):
+        self.index = index
+        self.item = item
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def status(self):
+        return getattr(self.error, 'status', None)
+
+    def __repr__(self):
+        return '<BulkResult %d: %r>' % (self.index, self.value if self.ok else self.error)
+
 class InvoicibleApiObjectManager(object):
     api_klass = None
     _resources_uri = None
+    _prefetch = ()
+    # results attached by prefetch_related - snapshot returned by all() instead of fetching
+    # until objects are created or changed through this manager
+    _result_cache = None
+    prefetch_workers = 8
+    # above this number of missing related objects loading whole related collection is tried
+    prefetch_all_threshold = 25
 
-    def __init__(self, invoicible_client, resources_uri=None):
+    def __init__(self, invoicible_client, resources_uri=None, lazy=False):
         self._client = invoicible_client
         self._resources_uri = resources_uri or self._resources_uri or self.api_klass._resources_uri
+        self.lazy = lazy
+
+    def _build(self, resource):
+        return self.api_klass(self._client, json=resource, lazy=self.lazy)
+
+    def _build_page(self, resources, request_id=None, prefetched=None):
+        started = time.time()
+        result = [self._build(resource) for resource in resources]
+        self._client.emit('build', {
+            'path': self._resources_uri, 'request_id': request_id or self._client.last_request_id,
+            'objects': len(result), 'build_time': time.time() - started,
+        })
+        if self._prefetch:
+            self._prefetch_related(result, {} if prefetched is None else prefetched)
+        return result
+
+    def prefetch_related(self, *fields):
+        """
+        Returns copy of manager which loads given related fields (for example 'customer'
+        or 'comments') for whole page of objects at once before they are returned.
+        Prefetched managers (like comments) keep returning loaded snapshot from all()
+        until something is created, saved or deleted through them.
+        """
+        for field in fields:
+            if not isinstance(getattr(self.api_klass, field, None),
+                    (InvoicibleApiFieldDescriptor, InvoicibleApiManagerFieldDescriptor)):
+                raise ValueError('%s has no related field %s' % (self.api_klass.__name__, field))
+        manager = copy.copy(self)
+        manager._prefetch = self._prefetch + fields
+        return manager
+
+    def _prefetch_related(self, api_objects, prefetched):
+        # prefetched keeps state shared by pages of one iteration
+        for field in self._prefetch:
+            descriptor = getattr(self.api_klass, field)
+            if isinstance(descriptor, InvoicibleApiFieldDescriptor):
+                self._prefetch_objects(descriptor, api_objects, prefetched)
+            else:
+                self._prefetch_managers(descriptor, api_objects)
+
+    def _prefetch_objects(self, descriptor, api_objects, prefetched):
+        identity_map = self._client.identity_map
+        # whole related collection when it was loaded by previous page of this iteration
+        collection = prefetched.get(descriptor.name) or {}
+        uris = set(getattr(api_object, descriptor.prepopulate_from, None) for api_object in api_objects)
+        uris.discard(None)
+        missing = [uri for uri in uris if uri not in collection and identity_map.get(uri) is None]
+        found = {}
+        if descriptor.name not in prefetched and descriptor.manager_klass is not None \
+          and self.prefetch_all_threshold < len(missing) <= identity_map.max_size:
+            # whole collection pays off only when it is not bigger than number of missing objects
+            # (so it also fits identity map) - it is tried once per iteration with limit telling that
+            page = descriptor.manager_klass(self._client).list(limit=len(missing) + 1)
+            found = dict((related.resource_uri, related) for related in page if related.resource_uri)
+            if len(page) <= len(missing):
+                prefetched[descriptor.name] = collection = found
+                for resource_uri, related in found.iteritems():
+                    identity_map.set(resource_uri, related)
+            else:
+                prefetched[descriptor.name] = None
+            missing = [uri for uri in missing if uri not in found]
+        found.update(zip(missing, self._run_concurrently(
+                lambda uri: self._client.get_object(descriptor.klass, uri), missing)))
+        for api_object in api_objects:
+            uri = getattr(api_object, descriptor.prepopulate_from, None)
+            if not uri:
+                continue
+            related = collection.get(uri) or found.get(uri) or identity_map.get(uri)
+            if related is None:
+                related = self._client.get_object(descriptor.klass, uri)
+            setattr(api_object, descriptor.name, related)
+
+    def _prefetch_managers(self, descriptor, api_objects):
+        managers = [descriptor.__get__(api_object, self.api_klass) for api_object in api_objects
+                if getattr(api_object, descriptor.prepopulate_from, None)]
+        results = self._run_concurrently(lambda manager: manager.all(), managers)
+        for manager, result in zip(managers, results):
+            manager._result_cache = result
+
+    def _run_concurrently(self, fn, items):
+        if len(items) <= 1:
+            return [fn(item) for item in items]
+        workers = WorkerPool(min(self.prefetch_workers, len(items)))
+        try:
+            return [future.result() for future in [workers.submit(fn, item) for item in items]]
+        finally:
+            workers.shutdown()
+
+    def add_hook(self, event, callback):
+        """
+        Registers client hook which receives only records concerning this manager resources.
+        """
+        def manager_callback(event, record):
+            if record.get('path', '').startswith(self._resources_uri):
+                callback(event, record)
+        self._client.add_hook(event, manager_callback)
+        return manager_callback
 
     def all(self, invoicible_client=None):
-        result = []
-        resources = self._client.get_resources(self._resources_uri)
+        if self._result_cache is not None:
+            return list(self._result_cache)
+        if self._prefetch:
+            resources = self._client.get_resources(self._resources_uri)
+            return self._build_page(resources)
+        return list(self.stream())
+
+    def stream(self, query=None):
+        """
+        Yields objects of the whole collection as soon as each of them is decoded from
+        response body. Connection is held until the generator is exhausted or closed, so
+        requests made while iterating (for example invoice.customer) use another one - with
+        max_connections=1 (or every connection held by streams) they raise PoolTimeout
+        after client pool_timeout. Use all() or iterator() then.
+        """
+        resources = self._client.iter_resources(self._resources_uri, query=query)
+        request_id = None
+        build_time = 0.0
+        count = 0
         for resource in resources:
-            result.append(self.api_klass(self._client, json=resource))
-        return result
+            if request_id is None:
+                # request is sent for the first resource
+                request_id = self._client.last_request_id
+            started = time.time()
+            api_object = self._build(resource)
+            build_time += time.time() - started
+            count += 1
+            yield api_object
+        self._client.emit('build', {
+            'path': self._resources_uri, 'request_id': request_id or self._client.last_request_id,
+            'objects': count, 'build_time': build_time,
+        })
 
     def list(self, offset=0, limit=20, query=None):
-        result = []
         query = dict({'offset': offset, 'limit': limit}, **query) if query else {'offset': offset, 'limit': limit}
         resources = self._client.get_resources(self._resources_uri,
                 query=query)
-        for resource in resources:
-            result.append(self.api_klass(self._client, json=resource))
-        return result
+        return self._build_page(resources)
+
+    def iterator(self, page_size=100, prefetch=1, query=None):
+        """
+        Yields objects one by one walking through offset/limit pages. Up to prefetch next pages
+        are fetched by background thread while current one is consumed (prefetch=0 disables it).
+        """
+        prefetched = {}
+        for resources, request_id in self._pages(page_size, prefetch, query):
+            for api_object in self._build_page(resources, request_id, prefetched):
+                yield api_object
+
+    def pages(self, page_size=100, prefetch=1, query=None):
+        """
+        Same as iterator() but yields pages of raw resources (decoded json dicts).
+        """
+        for resources, request_id in self._pages(page_size, prefetch, query):
+            yield resources
+
+    def _pages(self, page_size, prefetch, query):
+        if prefetch <= 0:
+            offset = 0
+            while True:
+                resources, request_id = self._fetch_page(offset, page_size, query)
+                yield resources, request_id
+                if len(resources) < page_size:
+                    return
+                offset += page_size
+
+        pages = Queue.Queue(prefetch)
+        stopped = threading.Event()
+        fetcher = threading.Thread(target=self._fetch_pages, args=(pages, stopped, page_size, query))
+        fetcher.daemon = True
+        fetcher.start()
+        try:
+            while True:
+                page, error = pages.get()
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                if page is None:
+                    return
+                yield page
+        finally:
+            stopped.set()
+
+    def _fetch_page(self, offset, limit, query):
+        page_query = dict(query or {}, offset=offset, limit=limit)
+        resources = self._client.get_resources(self._resources_uri, query=page_query)
+        return resources, self._client.last_request_id
+
+    def _fetch_pages(self, pages, stopped, page_size, query):
+        def put(page):
+            while not stopped.is_set():
+                try:
+                    pages.put(page, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        offset = 0
+        while True:
+            try:
+                resources, request_id = self._fetch_page(offset, page_size, query)
+            except Exception:
+                put((None, sys.exc_info()))
+                return
+            if not put(((resources, request_id), None)):
+                return
+            if len(resources) < page_size:
+                put((None, None))
+                return
+            offset += page_size
 
     def create(self, **kwargs):
+        self._result_cache = None
         resource = self._client.create_resource(self._resources_uri, kwargs)
-        return self.api_klass(self._client, json=resource)
+        return self._build(resource)
+
+    def bulk_create(self, iterable, concurrency=8):
+        """
+        Creates objects from iterable of field dicts running up to concurrency requests at once.
+        Requests are started right away, also when results are not consumed - returns iterator
+        of BulkResult for every entry in input order.
+        """
+        return self._bulk(lambda fields: self.create(**fields), iterable, concurrency)
+
+    def bulk_save(self, objects, concurrency=8):
+        """
+        Saves objects in the same way bulk_create() creates them.
+        """
+        def save(api_object):
+            api_object.save()
+            return api_object
+        return self._bulk(save, objects, concurrency)
+
+    def bulk_delete(self, resource_uris, concurrency=8):
+        """
+        Deletes resources in the same way bulk_create() creates them.
+        """
+        return self._bulk(self._client.delete_resource, resource_uris, concurrency)
+
+    def _bulk(self, fn, iterable, concurrency):
+        # feeder thread submits items as running calls finish, so all of them are processed
+        # even when returned results are never consumed
+        self._result_cache = None
+        workers = WorkerPool(concurrency)
+        running = threading.Semaphore(concurrency)
+        submitted = Queue.Queue()
+
+        def feed():
+            try:
+                for index, item in enumerate(iterable):
+                    running.acquire()
+                    future = workers.submit(fn, item)
+                    future.add_done_callback(lambda future: running.release())
+                    submitted.put((index, item, future, None))
+            except Exception:
+                submitted.put((None, None, None, sys.exc_info()))
+            finally:
+                # workers exit once submitted calls are done
+                workers.shutdown(wait=False)
+                submitted.put(None)
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        return self._bulk_results(submitted)
+
+    def _bulk_results(self, submitted):
+        while True:
+            entry = submitted.get()
+            if entry is None:
+                return
+            index, item, future, error = entry
+            if error is not None:
+                raise error[0], error[1], error[2]
+            yield self._bulk_result(index, item, future)
+
+    def _bulk_result(self, index, item, future):
+        error = future.exception()
+        if error is not None:
+            return BulkResult(index, item, error=error)
+        return BulkResult(index, item, value=future.result())
+
+    def all_async(self):
+        return _submit(self._client, self.all)
+
+    def list_async(self, *args, **kwargs):
+        return _submit(self._client, self.list, *args, **kwargs)
+
+    def create_async(self, **kwargs):
+        return _submit(self._client, self.create, **kwargs)
+
+def date_windows(date_from, date_to, shard='month'):
+    """
+    Splits date range (both ends inclusive) into consecutive (start, end) windows - shard
+    is 'day', 'week', 'month', 'year' or number of days.
+    """
+    if isinstance(date_from, basestring):
+        date_from = parse_date(date_from)
+    if isinstance(date_to, basestring):
+        date_to = parse_date(date_to)
+    windows = []
+    start = date_from
+    while start <= date_to:
+        if shard == 'month':
+            next_start = datetime.date(start.year + start.month // 12, start.month % 12 + 1, 1)
+        elif shard == 'year':
+            next_start = datetime.date(start.year + 1, 1, 1)
+        else:
+            days = {'day': 1, 'week': 7}.get(shard, shard)
+            if not isinstance(days, (int, long)) or days < 1:
+                raise ValueError('Incorrect shard: %r' % (shard,))
+            next_start = start + datetime.timedelta(days=days)
+        windows.append((start, min(next_start - datetime.timedelta(days=1), date_to)))
+        start = next_start
+    return windows
 
 class DateSliceableApiObjectManager(InvoicibleApiObjectManager):
-    def list(self, *args, **kwargs):
+    def _date_query(self, kwargs):
         date_from, date_to = kwargs.pop('date_from', None), kwargs.pop('date_to', None)
-        query = kwargs.setdefault('query', {})
+        query = dict(kwargs.get('query') or {})
         if date_from:
             query['date_from'] = date_from if isinstance(date_from, basestring) else date_from.strftime(DATE_FORMAT)
         if date_to:
             query['date_to'] = date_to if isinstance(date_to, basestring) else date_to.strftime(DATE_FORMAT)
-        return super(DateSliceableApiObjectManager, self).list(*args, **kwargs)
+        kwargs['query'] = query
+        return kwargs
+
+    def list(self, *args, **kwargs):
+        return super(DateSliceableApiObjectManager, self).list(*args, **self._date_query(kwargs))
+
+    def iterator(self, *args, **kwargs):
+        return super(DateSliceableApiObjectManager, self).iterator(*args, **self._date_query(kwargs))
+
+    def pages(self, *args, **kwargs):
+        return super(DateSliceableApiObjectManager, self).pages(*args, **self._date_query(kwargs))
+
+    def fetch_range(self, date_from, date_to, shard='month', workers=4, page_size=100, query=None):
+        """
+        Splits date range into windows (see date_windows) fetched concurrently by up to workers
+        threads and yields objects in date order. Objects returned by two adjacent windows
+        (e.g. when server treats window ends differently) are yielded once.
+        """
+        pool = WorkerPool(workers)
+        pending = collections.deque()
+        previous_uris = set()
+        prefetched = {}
+        windows = iter(date_windows(date_from, date_to, shard))
+        try:
+            for window in itertools.islice(windows, workers):
+                pending.append(pool.submit(self._fetch_window, window, page_size, query))
+            while pending:
+                resources = pending.popleft().result()
+                for window in itertools.islice(windows, 1):
+                    pending.append(pool.submit(self._fetch_window, window, page_size, query))
+                uris = set()
+                fresh = []
+                for resource in resources:
+                    resource_uri = resource.get('resource_uri')
+                    if resource_uri is not None:
+                        if resource_uri in previous_uris or resource_uri in uris:
+                            continue
+                        uris.add(resource_uri)
+                    fresh.append(resource)
+                previous_uris = uris
+                for api_object in self._build_page(fresh, prefetched=prefetched):
+                    yield api_object
+        finally:
+            pool.shutdown(wait=not pending)
+
+    def _fetch_window(self, window, page_size, query):
+        resources = []
+        for page in self.pages(page_size=page_size, prefetch=0, query=query, date_from=window[0], date_to=window[1]):
+            resources.extend(page)
+        # sort is stable so server order is kept for objects from the same day
+        resources.sort(key=lambda resource: resource.get('date'))
+        return resources
 
 class Customer(InvoicibleApiObject):
     _resources_uri = '/api/1.0/customers/'
@@ -313,6 +1980,7 @@ class CommentManager(InvoicibleApiObjectManager):
     api_klass = Comment
 
 class Item(object):
+    __metaclass__ = CompiledFieldsMeta
     _fields = {
         'amount': unicode,
         'description': unicode,
@@ -326,9 +1994,17 @@ class Item(object):
         for key, value in kwargs.items():
             setattr(self, key, self._fields[key](value))
 
+    @classmethod
+    def from_json(cls, data):
+        item = cls.__new__(cls)
+        for f, decode in cls._decoders:
+            if f in data:
+                setattr(item, f, decode(data[f]))
+        return item
+
     def get_json(self):
         result = {}
-        for key in self._fields.keys():
+        for key, encode in self._encoders:
             result[key] = getattr(self, key, None)
         return result
 
@@ -365,7 +2041,7 @@ class Invoice(InvoicibleApiObject):
         'status': unicode,
         'summary': unicode,
     }
-    customer = InvoicibleApiFieldDescriptor('customer_uri', Customer)
+    customer = InvoicibleApiFieldDescriptor('customer_uri', Customer, CustomerManager)
     comments = InvoicibleApiManagerFieldDescriptor('comments_uri', CommentManager)
 
 class InvoiceManager(DateSliceableApiObjectManager):
@@ -381,7 +2057,7 @@ class Estimate(InvoicibleApiObject):
         'summary': unicode,
         'status': unicode,
     }
-    customer = InvoicibleApiFieldDescriptor('customer_uri', Customer)
+    customer = InvoicibleApiFieldDescriptor('customer_uri', Customer, CustomerManager)
     comments = InvoicibleApiManagerFieldDescriptor('comments_uri', CommentManager)
 
 class EstimateManager(DateSliceableApiObjectManager):
@@ -0,0 +1,137 @@
+# -coding: utf-8 -
+"""
+Streaming export of invoicible resources to CSV or JSON Lines files.
+
+Resources are written page by page as they arrive (next pages are fetched and decoded by
+background thread meanwhile), so memory use depends on page size only. With items=True
+invoices and estimates are flattened to one row per Item.
+
+    import invoicible_export
+    invoicible_export.export(client, 'invoices', 'invoices.csv.gz', items=True)
+"""
+import codecs
+import collections
+import csv
+import gzip
+
+import simplejson
+
+import invoicible
+
+MANAGERS = {
+    'invoices': invoicible.InvoiceManager,
+    'estimates': invoicible.EstimateManager,
+    'customers': invoicible.CustomerManager,
+}
+
+FORMATS = ('csv', 'jsonl')
+
+# column name prefix used for Item fields in flattened rows
+ITEM_PREFIX = 'item_'
+
+def default_columns(kind):
+    fields = MANAGERS[kind].api_klass._fields
+    return ['resource_uri'] + sorted(f for f in fields if f not in ('resource_uri', 'items'))
+
+def default_item_columns():
+    return sorted(invoicible.Item._fields)
+
+class CsvWriter(object):
+    def __init__(self, stream, columns):
+        self.writer = csv.writer(stream)
+        self.writer.writerow([column.encode('utf-8') for column in columns])
+
+    def write(self, row):
+        self.writer.writerow([self._cell(value) for value in row.itervalues()])
+
+    def _cell(self, value):
+        if value is None:
+            return ''
+        if isinstance(value, (dict, list)):
+            return simplejson.dumps(value)
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+class JsonLinesWriter(object):
+    def __init__(self, stream, columns):
+        self.stream = codecs.getwriter('utf-8')(stream)
+
+    def write(self, row):
+        self.stream.write(simplejson.dumps(row, ensure_ascii=False))
+        self.stream.write(u'\n')
+
+WRITERS = {
+    'csv': CsvWriter,
+    'jsonl': JsonLinesWriter,
+}
+
+def guess_format(path):
+    """
+    Returns (format, compress) guessed from file name, e.g. 'out.jsonl.gz' -> ('jsonl', True).
+    """
+    compress = path.endswith('.gz')
+    if compress:
+        path = path[:-len('.gz')]
+    extension = path.rsplit('.', 1)[-1].lower()
+    return ('jsonl' if extension in ('jsonl', 'json') else 'csv'), compress
+
+def rows(pages, columns, item_columns=None):
+    """
+    Turns pages of raw resources into ordered rows. When item_columns are given every
+    resource gives one row per item (and one row with empty item columns when it has none).
+    """
+    for resources in pages:
+        for resource in resources:
+            row = collections.OrderedDict((column, resource.get(column)) for column in columns)
+            if item_columns is None:
+                yield row
+                continue
+            items = resource.get('items') or [{}]
+            for item in items:
+                item_row = row.copy()
+                for column in item_columns:
+                    item_row[ITEM_PREFIX + column] = item.get(column)
+                yield item_row
+
+def export(client, kind, path, format=None, columns=None, items=False, item_columns=None,
+        compress=None, page_size=100, prefetch=2, date_from=None, date_to=None, query=None):
+    """
+    Writes all resources of given kind ('invoices', 'estimates' or 'customers') to path and
+    returns number of written rows. Format and compression are guessed from path by default.
+    """
+    if kind not in MANAGERS:
+        raise ValueError('Unknown kind %s' % kind)
+    guessed_format, guessed_compress = guess_format(path)
+    format = format or guessed_format
+    if format not in WRITERS:
+        raise ValueError('Unknown format %s' % format)
+    if compress is None:
+        compress = guessed_compress
+
+    columns = list(columns or default_columns(kind))
+    if items or item_columns:
+        if 'items' not in MANAGERS[kind].api_klass._fields:
+            raise ValueError('%s have no items' % kind)
+        item_columns = list(item_columns or default_item_columns())
+    else:
+        item_columns = None
+
+    manager = MANAGERS[kind](client)
+    if isinstance(manager, invoicible.DateSliceableApiObjectManager):
+        pages = manager.pages(page_size=page_size, prefetch=prefetch, query=query,
+                date_from=date_from, date_to=date_to)
+    else:
+        pages = manager.pages(page_size=page_size, prefetch=prefetch, query=query)
+
+    stream = gzip.open(path, 'wb') if compress else open(path, 'wb')
+    count = 0
+    try:
+        writer = WRITERS[format](stream, columns + [ITEM_PREFIX + column for column in item_columns or ()])
+        for row in rows(pages, columns, item_columns):
+            writer.write(row)
+            count += 1
+    finally:
+        pages.close()
+        stream.close()
+    return count
@@ -0,0 +1,306 @@
+# -coding: utf-8 -
+"""
+Reports over invoice line items.
+
+LineItemTable keeps one row per Item in columns: dimensions (customer, month, currency,
+tax rate...) are dictionary encoded into int arrays and numbers are parsed once into
+scaled int arrays, so sums are exact and do not touch Decimal until the result.
+
+    table = LineItemTable.from_manager(InvoiceManager(client), date_from, date_to)
+    table.net(by=('customer', 'month'), where={'currency': u'zł'})
+    table.report(by='tax_rate')
+"""
+import array
+import collections
+import decimal
+import itertools
+
+import invoicible
+
+AMOUNT_SCALE = 4
+PRICE_SCALE = 4
+TAX_RATE_SCALE = 2
+# net = amount * unit_price
+NET_SCALE = AMOUNT_SCALE + PRICE_SCALE
+# tax = net * tax_rate / 100
+TAX_SCALE = NET_SCALE + TAX_RATE_SCALE + 2
+
+# dimension -> function returning its value from invoice json
+INVOICE_DIMENSIONS = collections.OrderedDict([
+    ('invoice', lambda invoice: invoice.get('resource_uri')),
+    ('customer', lambda invoice: invoice.get('customer_uri')),
+    ('customer_name', lambda invoice: invoice.get('customer_name')),
+    ('date', lambda invoice: invoice.get('date')),
+    ('month', lambda invoice: (invoice.get('date') or '')[:7] or None),
+    ('currency', lambda invoice: invoice.get('currency_symbol')),
+    ('status', lambda invoice: invoice.get('status')),
+])
+# dimension -> Item field
+ITEM_DIMENSIONS = collections.OrderedDict([
+    ('tax_rate', 'tax_rate'),
+    ('product', 'product_id'),
+    ('unit', 'unit'),
+])
+DIMENSIONS = tuple(INVOICE_DIMENSIONS) + tuple(ITEM_DIMENSIONS)
+
+MEASURES = {
+    'amount': AMOUNT_SCALE,
+    'unit_price': PRICE_SCALE,
+    'net': NET_SCALE,
+}
+
+# scaled numbers need 64 bit ints - Python 2 array has no 'q' typecode, but 'l' is 64 bit
+# on LP64 platforms (elsewhere plain lists are used). Measure columns of table which gets
+# even bigger value are converted to lists too.
+if array.array('l').itemsize >= 8:
+    int64_column = lambda: array.array('l')
+else:
+    int64_column = list
+
+# number of distinct strings remembered by parse_scaled memo tables
+PARSE_MEMO_SIZE = 10000
+
+def parse_scaled(value, scale):
+    """
+    Parses decimal string (dot or comma separated, empty means 0) to int scaled by 10**scale.
+    Raises ValueError for non numbers and for values with more than scale decimal places.
+    """
+    if value is None:
+        return 0
+    text = unicode(value).strip().replace(u',', u'.')
+    if not text:
+        return 0
+    negative = text.startswith(u'-')
+    if negative or text.startswith(u'+'):
+        text = text[1:]
+    whole, _, fraction = text.partition(u'.')
+    fraction = fraction.rstrip(u'0')
+    if len(fraction) > scale or not (whole or fraction) or not (whole + fraction).isdigit():
+        raise ValueError('Invalid decimal value (max %d decimal places): %r' % (scale, value))
+    result = int(whole or 0) * 10 ** scale + int(fraction.ljust(scale, u'0') or 0)
+    return -result if negative else result
+
+def to_decimal(value, scale):
+    return decimal.Decimal('%de-%d' % (value, scale))
+
+class LineItemTable(object):
+    def __init__(self):
+        self.labels = dict((dimension, []) for dimension in DIMENSIONS)
+        self._codes = dict((dimension, {}) for dimension in DIMENSIONS)
+        self.columns = dict((dimension, array.array('i')) for dimension in DIMENSIONS)
+        for measure in MEASURES:
+            self.columns[measure] = int64_column()
+        # numeric value of every tax_rate label (non numeric ones, like 'zw', are 0)
+        self.tax_rates = []
+        self._memo = dict((measure, {}) for measure in ('amount', 'unit_price'))
+
+    def __len__(self):
+        return len(self.columns['net'])
+
+    @classmethod
+    def from_manager(cls, manager, date_from=None, date_to=None, page_size=100):
+        """
+        Loads invoices (or estimates) of given manager page by page, optionally limited
+        to date range when manager supports it.
+        """
+        if isinstance(manager, invoicible.DateSliceableApiObjectManager):
+            pages = manager.pages(page_size=page_size, date_from=date_from, date_to=date_to)
+        else:
+            pages = manager.pages(page_size=page_size)
+        table = cls()
+        for resources in pages:
+            table.load(resources)
+        return table
+
+    def load(self, invoices):
+        """
+        Appends line items of given invoices - Invoice/Estimate objects or raw json dicts.
+        Returns number of added lines.
+        """
+        item_dimensions = [(dimension, field, self._codes[dimension], self.columns[dimension].append)
+                for dimension, field in ITEM_DIMENSIONS.iteritems()]
+        append_amount = self.columns['amount'].append
+        append_unit_price = self.columns['unit_price'].append
+        append_net = self.columns['net'].append
+        amount_memo, unit_price_memo = self._memo['amount'], self._memo['unit_price']
+        added = 0
+        for invoice in invoices:
+            if isinstance(invoice, invoicible.InvoicibleApiObject):
+                invoice = invoice.get_json()
+            items = invoice.get('items')
+            if not items:
+                continue
+            # invoice dimensions are the same for all its lines
+            invoice_codes = [(self.columns[dimension].append, self._code(dimension, getter(invoice)))
+                    for dimension, getter in INVOICE_DIMENSIONS.iteritems()]
+            for item in items:
+                if isinstance(item, invoicible.Item):
+                    item = item.get_json()
+                # numbers are parsed and measures appended first - dimension columns are
+                # appended only for valid lines, so all columns stay of the same length
+                amount = amount_memo.get(item.get('amount'))
+                if amount is None:
+                    amount = self._parse('amount', item.get('amount'), AMOUNT_SCALE)
+                unit_price = unit_price_memo.get(item.get('unit_price'))
+                if unit_price is None:
+                    unit_price = self._parse('unit_price', item.get('unit_price'), PRICE_SCALE)
+                net = amount * unit_price
+                try:
+                    append_net(net)
+                    append_amount(amount)
+                    append_unit_price(unit_price)
+                except OverflowError:
+                    self._widen_measures()
+                    append_amount = self.columns['amount'].append
+                    append_unit_price = self.columns['unit_price'].append
+                    append_net = self.columns['net'].append
+                    append_net(net)
+                    append_amount(amount)
+                    append_unit_price(unit_price)
+                for append, code in invoice_codes:
+                    append(code)
+                for dimension, field, codes, append in item_dimensions:
+                    label = item.get(field)
+                    code = codes.get(label)
+                    append(code if code is not None else self._code(dimension, label))
+            added += len(items)
+        return added
+
+    def _widen_measures(self):
+        # values of line which did not fit are dropped too
+        rows = len(self.columns[DIMENSIONS[0]])
+        for measure in MEASURES:
+            self.columns[measure] = list(self.columns[measure][:rows])
+
+    def _code(self, dimension, label):
+        codes = self._codes[dimension]
+        code = codes.get(label)
+        if code is None:
+            code = codes[label] = len(self.labels[dimension])
+            self.labels[dimension].append(label)
+            if dimension == 'tax_rate':
+                try:
+                    rate = parse_scaled(label, TAX_RATE_SCALE)
+                except ValueError:
+                    rate = 0
+                self.tax_rates.append(rate)
+        return code
+
+    def _parse(self, measure, value, scale):
+        memo = self._memo[measure]
+        try:
+            hash(value)
+        except TypeError:
+            return parse_scaled(value, scale)
+        if len(memo) >= PARSE_MEMO_SIZE:
+            memo.clear()
+        result = memo[value] = parse_scaled(value, scale)
+        return result
+
+    def _dimensions(self, by):
+        if by is None:
+            return ()
+        by = (by,) if isinstance(by, basestring) else tuple(by)
+        for dimension in by:
+            if dimension not in DIMENSIONS:
+                raise ValueError('Unknown dimension %s' % dimension)
+        return by
+
+    def _mask(self, where):
+        # None when all rows are selected
+        if not where:
+            return None
+        mask = None
+        for dimension, values in where.iteritems():
+            if dimension not in DIMENSIONS:
+                raise ValueError('Unknown dimension %s' % dimension)
+            if isinstance(values, (basestring, type(None))) or not hasattr(values, '__iter__'):
+                values = (values,)
+            codes = frozenset(self._codes[dimension][value] for value in values if value in self._codes[dimension])
+            selected = [code in codes for code in self.columns[dimension]]
+            mask = selected if mask is None else [a and b for a, b in itertools.izip(mask, selected)]
+        return mask
+
+    def _sum_codes(self, values, by, mask):
+        """
+        Sums scaled ints grouping them by codes of given dimensions.
+        """
+        if not by:
+            values = values if mask is None else itertools.compress(values, mask)
+            return {(): sum(values)}
+        if len(by) == 1:
+            keys = self.columns[by[0]]
+        else:
+            keys = itertools.izip(*[self.columns[dimension] for dimension in by])
+        pairs = itertools.izip(keys, values)
+        if mask is not None:
+            pairs = itertools.compress(pairs, mask)
+        totals = collections.defaultdict(int)
+        for key, value in pairs:
+            totals[key] += value
+        if len(by) == 1:
+            return dict(((key,), total) for key, total in totals.iteritems())
+        return totals
+
+    def _labelled(self, by, totals, scale):
+        if not by:
+            return to_decimal(totals.get((), 0), scale)
+        result = {}
+        for key, total in totals.iteritems():
+            labels = tuple(self.labels[dimension][code] for dimension, code in zip(by, key))
+            result[labels[0] if len(by) == 1 else labels] = to_decimal(total, scale)
+        return result
+
+    def sum(self, measure, by=None, where=None):
+        """
+        Returns exact Decimal sum of measure ('amount', 'unit_price' or 'net') or, with by
+        (dimension name or tuple of them), dict of sums keyed by dimension labels (tuples
+        of labels for more dimensions). where limits rows to given dimension values, for
+        example where={'currency': u'zł', 'month': ('2010-01', '2010-02')}.
+        """
+        if measure not in MEASURES:
+            raise ValueError('Unknown measure %s' % measure)
+        by = self._dimensions(by)
+        return self._labelled(by, self._sum_codes(self.columns[measure], by, self._mask(where)), MEASURES[measure])
+
+    def net(self, by=None, where=None):
+        return self.sum('net', by, where)
+
+    def _tax_totals(self, by, mask):
+        # net is summed per tax rate first, so rate multiplication runs once per group
+        totals = self._sum_codes(self.columns['net'], by + ('tax_rate',), mask)
+        tax = collections.defaultdict(int)
+        for key, net in totals.iteritems():
+            tax[key[:-1]] += net * self.tax_rates[key[-1]]
+        return tax
+
+    def tax(self, by=None, where=None):
+        by = self._dimensions(by)
+        return self._labelled(by, self._tax_totals(by, self._mask(where)), TAX_SCALE)
+
+    def gross(self, by=None, where=None):
+        by = self._dimensions(by)
+        mask = self._mask(where)
+        net = self._sum_codes(self.columns['net'], by, mask)
+        tax = self._tax_totals(by, mask)
+        factor = 10 ** (TAX_SCALE - NET_SCALE)
+        gross = dict((key, total * factor + tax.get(key, 0)) for key, total in net.iteritems())
+        return self._labelled(by, gross, TAX_SCALE)
+
+    def report(self, by=None, where=None):
+        """
+        Returns list of (labels, net, tax, gross) rows sorted by labels - labels is tuple
+        of dimension values (empty without by).
+        """
+        by = self._dimensions(by)
+        mask = self._mask(where)
+        net = self._sum_codes(self.columns['net'], by, mask)
+        tax = self._tax_totals(by, mask)
+        factor = 10 ** (TAX_SCALE - NET_SCALE)
+        rows = []
+        for key, total in net.iteritems():
+            labels = tuple(self.labels[dimension][code] for dimension, code in zip(by, key))
+            rows.append((labels, to_decimal(total, NET_SCALE), to_decimal(tax.get(key, 0), TAX_SCALE),
+                to_decimal(total * factor + tax.get(key, 0), TAX_SCALE)))
+        rows.sort()
+        return rows
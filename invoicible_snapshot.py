@@ -0,0 +1,205 @@
+# -coding: utf-8 -
+"""
+Binary snapshots of api object graphs for fast warm starts.
+
+dump() writes objects (with their not yet decoded json, ItemList items included) and
+resolved related objects, like invoice customers, as marshal records followed by offset
+index. load() memory maps the file - opening it costs the same for any number of objects
+and every object is built (lazily decoded) only when it is accessed.
+
+    invoicible_snapshot.dump('invoices.snapshot', InvoiceManager(client).prefetch_related('customer').all())
+    snapshot = invoicible_snapshot.load('invoices.snapshot', client)
+    snapshot.get('/api/1.0/invoices/1/').customer.name
+
+Snapshots written for another format or field schema (or different version when one
+was given) are rejected with StaleSnapshot.
+"""
+import array
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+
+import invoicible
+
+MAGIC = 'INVSNAP\0'
+FORMAT_VERSION = 1
+# file is header, records, meta (right before index), index of record offsets and marshalled
+# dict of resource_uri -> record index
+
+# magic, format version, meta length, record count, index offset, uri index offset
+HEADER = struct.Struct('<8sIIQQQ')
+OFFSET = struct.Struct('<Q')
+
+# class codes are positions in this tuple - append only
+SNAPSHOT_CLASSES = (invoicible.Customer, invoicible.Invoice, invoicible.Estimate, invoicible.Comment)
+
+class StaleSnapshot(ValueError):
+    pass
+
+def schema_stamp(classes=SNAPSHOT_CLASSES):
+    """
+    Returns hash of snapshot format and field schema of given classes.
+    """
+    schema = [FORMAT_VERSION] + [(klass.__name__, sorted((f, t.__name__) for f, t in klass._fields.items()))
+            for klass in classes]
+    return hashlib.sha1(repr(schema)).hexdigest()
+
+def related_descriptors(klass):
+    return [(name, getattr(klass, name)) for name in sorted(dir(klass))
+            if isinstance(getattr(klass, name, None), invoicible.InvoicibleApiFieldDescriptor)]
+
+def _resolved(api_object, descriptor):
+    # related object only when it was already fetched (or attached by prefetch_related)
+    related = getattr(api_object, descriptor.name, None)
+    if related is None or related.resource_uri != getattr(api_object, descriptor.prepopulate_from, None):
+        return None
+    return related
+
+def dump(path, api_objects, version=None):
+    """
+    Writes objects and their resolved related objects to path (replaced atomically).
+    Returns number of written records.
+    """
+    codes = dict((klass, code) for code, klass in enumerate(SNAPSHOT_CLASSES))
+    descriptors = dict((klass, related_descriptors(klass)) for klass in SNAPSHOT_CLASSES)
+    offsets = []
+    classes = array.array('B')
+    written = {}
+    uris = {}
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    output = open(temporary, 'wb')
+
+    def add(api_object):
+        key = api_object.resource_uri or id(api_object)
+        if key in written:
+            return written[key]
+        klass = type(api_object)
+        if klass not in codes:
+            raise ValueError('%s objects can not be stored in snapshot' % klass.__name__)
+        links = []
+        for name, descriptor in descriptors[klass]:
+            related = _resolved(api_object, descriptor)
+            if related is not None:
+                links.append((name, add(related)))
+        index = written[key] = len(classes)
+        json = api_object.get_json()
+        json.pop('resource_uri', None)
+        offsets.append(output.tell())
+        classes.append(codes[klass])
+        output.write(marshal.dumps((api_object.resource_uri, json, tuple(links)), 2))
+        if api_object.resource_uri:
+            uris[api_object.resource_uri] = index
+        return index
+
+    try:
+        output.write('\0' * HEADER.size)
+        for api_object in api_objects:
+            add(api_object)
+        offsets.append(output.tell())
+        meta = marshal.dumps({
+            'stamp': schema_stamp(),
+            'version': version,
+            'classes': classes.tostring(),
+        }, 2)
+        output.write(meta)
+        index_offset = output.tell()
+        for offset in offsets:
+            output.write(OFFSET.pack(offset))
+        uri_index_offset = output.tell()
+        output.write(marshal.dumps(uris, 2))
+        output.seek(0)
+        output.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(meta), len(classes), index_offset, uri_index_offset))
+        output.close()
+        os.rename(temporary, path)
+    except:
+        output.close()
+        os.remove(temporary)
+        raise
+    return len(classes)
+
+class Snapshot(object):
+    """
+    Read only view of snapshot file. Objects are materialized (as lazy api objects bound
+    to client and put into its identity map) on first access and then reused.
+    """
+    def __init__(self, path, client, version=None):
+        self.client = client
+        with open(path, 'rb') as snapshot_file:
+            self._buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_header(version)
+        except:
+            self._buffer.close()
+            raise
+        self._objects = {}
+        self._uris = None
+
+    def _read_header(self, version):
+        if len(self._buffer) < HEADER.size:
+            raise StaleSnapshot('Not an invoicible snapshot')
+        magic, format_version, meta_length, self._count, self._index_offset, self._uri_index_offset = \
+                HEADER.unpack_from(self._buffer, 0)
+        if magic != MAGIC:
+            raise StaleSnapshot('Not an invoicible snapshot')
+        if format_version != FORMAT_VERSION:
+            raise StaleSnapshot('Snapshot format %d is not supported' % format_version)
+        meta_end = self._index_offset
+        meta = marshal.loads(self._buffer[meta_end - meta_length:meta_end])
+        if meta['stamp'] != schema_stamp():
+            raise StaleSnapshot('Snapshot was written for different api classes schema')
+        if version is not None and meta['version'] != version:
+            raise StaleSnapshot('Snapshot version %r does not match %r' % (meta['version'], version))
+        self.version = meta['version']
+        self._classes = meta['classes']
+
+    def close(self):
+        self._buffer.close()
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for index in xrange(self._count):
+            yield self[index]
+
+    def objects(self, klass):
+        """
+        Yields objects of given class in snapshot order.
+        """
+        code = chr(SNAPSHOT_CLASSES.index(klass))
+        index = self._classes.find(code)
+        while index != -1:
+            yield self[index]
+            index = self._classes.find(code, index + 1)
+
+    def get(self, resource_uri):
+        if self._uris is None:
+            self._uris = marshal.loads(self._buffer[self._uri_index_offset:])
+        try:
+            return self[self._uris[resource_uri]]
+        except KeyError:
+            raise invoicible.DoesNotExists(resource_uri)
+
+    def __getitem__(self, index):
+        try:
+            return self._objects[index]
+        except KeyError:
+            pass
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        start, end = struct.unpack_from('<QQ', self._buffer, self._index_offset + index * OFFSET.size)
+        resource_uri, json, links = marshal.loads(self._buffer[start:end])
+        api_klass = SNAPSHOT_CLASSES[ord(self._classes[index])]
+        api_object = api_klass(self.client, json=json, lazy=True)
+        object.__setattr__(api_object, 'resource_uri', resource_uri)
+        self._objects[index] = api_object
+        for name, related_index in links:
+            setattr(api_object, getattr(api_klass, name).name, self[related_index])
+        if resource_uri:
+            self.client.identity_map.set(resource_uri, api_object)
+        return api_object
+
+def load(path, client, version=None):
+    return Snapshot(path, client, version)
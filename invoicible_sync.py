@@ -0,0 +1,204 @@
+# -coding: utf-8 -
+"""
+Local SQLite mirror of invoicible resources.
+
+First sync() loads whole collections, following ones fetch only recent date windows
+(starting overlap_days before the previous sync) and upsert what has changed. Objects
+which are no longer returned for fetched window (or reloaded collection) were deleted
+on the server and are removed from the mirror too. Query methods return regular api
+objects built from the local store.
+"""
+import datetime
+import sqlite3
+import time
+
+import simplejson
+
+import invoicible
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    resource_uri TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    date TEXT,
+    customer_uri TEXT,
+    status TEXT,
+    json TEXT NOT NULL,
+    synced_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_kind_date ON objects (kind, date);
+CREATE INDEX IF NOT EXISTS objects_kind_customer ON objects (kind, customer_uri);
+CREATE TABLE IF NOT EXISTS items (
+    resource_uri TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    amount TEXT,
+    description TEXT,
+    product_id TEXT,
+    tax_rate TEXT,
+    unit TEXT,
+    unit_price TEXT,
+    PRIMARY KEY (resource_uri, position)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    kind TEXT PRIMARY KEY,
+    synced_to TEXT NOT NULL,
+    synced_at REAL NOT NULL
+);
+"""
+
+ITEM_COLUMNS = ('amount', 'description', 'product_id', 'tax_rate', 'unit', 'unit_price')
+
+def date_parameter(value):
+    """
+    Returns date (datetime.date or DATE_FORMAT string) as stored in date column.
+    """
+    if isinstance(value, basestring):
+        value = invoicible.parse_date(value)
+    return invoicible.format_date(value)
+
+class LocalMirror(object):
+    # kind -> manager class, collections without date slicing are always reloaded as a whole
+    managers = {
+        'invoices': invoicible.InvoiceManager,
+        'estimates': invoicible.EstimateManager,
+        'customers': invoicible.CustomerManager,
+    }
+
+    def __init__(self, client, path, page_size=100, overlap_days=30):
+        self.client = client
+        self.page_size = page_size
+        self.overlap_days = overlap_days
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        # resource uris returned by current sync of a kind
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS fetched (resource_uri TEXT PRIMARY KEY)')
+
+    def close(self):
+        self.db.close()
+
+    def sync(self, kinds=None, today=None):
+        """
+        Synchronizes given kinds (all by default) and returns number of upserted objects.
+        Local objects of fetched date window (whole collection when it was reloaded) which
+        server has not returned are deleted.
+        """
+        today = today or datetime.date.today()
+        upserted = 0
+        for kind in kinds or sorted(self.managers):
+            manager = self.managers[kind](self.client)
+            synced_to = self._synced_to(kind)
+            if synced_to is None or not isinstance(manager, invoicible.DateSliceableApiObjectManager):
+                date_from = date_to = None
+                pages = manager.pages(page_size=self.page_size)
+            else:
+                date_from, date_to = synced_to - datetime.timedelta(days=self.overlap_days), today
+                pages = manager.pages(page_size=self.page_size, date_from=date_from, date_to=date_to)
+            with self.db:
+                self.db.execute('DELETE FROM fetched')
+                for resources in pages:
+                    upserted += self._upsert(kind, resources)
+                self._remove_deleted(kind, date_from, date_to)
+                self.db.execute('INSERT OR REPLACE INTO sync_state (kind, synced_to, synced_at) VALUES (?, ?, ?)',
+                        (kind, invoicible.format_date(today), time.time()))
+        return upserted
+
+    def full_load(self, kinds=None):
+        """
+        Forgets sync state so next sync() reloads whole collections.
+        """
+        with self.db:
+            for kind in kinds or sorted(self.managers):
+                self.db.execute('DELETE FROM sync_state WHERE kind = ?', (kind,))
+        return self.sync(kinds)
+
+    def _synced_to(self, kind):
+        row = self.db.execute('SELECT synced_to FROM sync_state WHERE kind = ?', (kind,)).fetchone()
+        return invoicible.parse_date(row[0]) if row else None
+
+    def _upsert(self, kind, resources):
+        now = time.time()
+        count = 0
+        for resource in resources:
+            resource_uri = resource.get('resource_uri')
+            if not resource_uri:
+                continue
+            self.db.execute(
+                'INSERT OR REPLACE INTO objects (resource_uri, kind, date, customer_uri, status, json, synced_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (resource_uri, kind, resource.get('date'), resource.get('customer_uri'), resource.get('status'),
+                    simplejson.dumps(resource), now)
+            )
+            self.db.execute('DELETE FROM items WHERE resource_uri = ?', (resource_uri,))
+            self.db.executemany(
+                'INSERT INTO items (resource_uri, position, %s) VALUES (?, ?, %s)' % (
+                    ', '.join(ITEM_COLUMNS), ', '.join('?' * len(ITEM_COLUMNS))),
+                [(resource_uri, position) + tuple(item.get(column) for column in ITEM_COLUMNS)
+                    for position, item in enumerate(resource.get('items') or ())]
+            )
+            self.db.execute('INSERT OR IGNORE INTO fetched (resource_uri) VALUES (?)', (resource_uri,))
+            count += 1
+        return count
+
+    def _remove_deleted(self, kind, date_from=None, date_to=None):
+        condition = 'kind = ? AND resource_uri NOT IN (SELECT resource_uri FROM fetched)'
+        parameters = [kind]
+        if date_from is not None:
+            condition += ' AND date >= ? AND date <= ?'
+            parameters += [invoicible.format_date(date_from), invoicible.format_date(date_to)]
+        self.db.execute('DELETE FROM items WHERE resource_uri IN (SELECT resource_uri FROM objects WHERE %s)'
+                % condition, parameters)
+        return self.db.execute('DELETE FROM objects WHERE %s' % condition, parameters).rowcount
+
+    def _query(self, kind, date_from=None, date_to=None, customer_uri=None, status=None):
+        conditions, parameters = ['kind = ?'], [kind]
+        date_from = date_parameter(date_from) if date_from is not None else None
+        date_to = date_parameter(date_to) if date_to is not None else None
+        for condition, value in (('date >= ?', date_from), ('date <= ?', date_to),
+                ('customer_uri = ?', customer_uri), ('status = ?', status)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        cursor = self.db.execute('SELECT resource_uri, json FROM objects WHERE %s ORDER BY date, resource_uri'
+                % ' AND '.join(conditions), parameters)
+        api_klass = self.managers[kind].api_klass
+        for resource_uri, json in cursor:
+            yield self._build(api_klass, resource_uri, json)
+
+    def _build(self, api_klass, resource_uri, json):
+        api_object = api_klass(self.client, json=simplejson.loads(json), lazy=True)
+        if not api_object.resource_uri:
+            # not all api classes decode resource_uri field
+            api_object.resource_uri = resource_uri
+        return api_object
+
+    def invoices(self, date_from=None, date_to=None, customer_uri=None, status=None):
+        return self._query('invoices', date_from, date_to, customer_uri, status)
+
+    def estimates(self, date_from=None, date_to=None, customer_uri=None, status=None):
+        return self._query('estimates', date_from, date_to, customer_uri, status)
+
+    def customers(self):
+        return self._query('customers')
+
+    def get(self, resource_uri):
+        row = self.db.execute('SELECT kind, json FROM objects WHERE resource_uri = ?', (resource_uri,)).fetchone()
+        if row is None:
+            raise invoicible.DoesNotExists(resource_uri)
+        return self._build(self.managers[row[0]].api_klass, resource_uri, row[1])
+
+    def line_items(self, date_from=None, date_to=None):
+        """
+        Yields (resource_uri, Item) pairs of invoice lines - dates limit invoice date.
+        """
+        query = 'SELECT items.resource_uri, %s FROM items JOIN objects USING (resource_uri) ' \
+                'WHERE objects.kind = ?' % ', '.join('items.' + column for column in ITEM_COLUMNS)
+        parameters = ['invoices']
+        if date_from is not None:
+            query += ' AND objects.date >= ?'
+            parameters.append(date_parameter(date_from))
+        if date_to is not None:
+            query += ' AND objects.date <= ?'
+            parameters.append(date_parameter(date_to))
+        for row in self.db.execute(query + ' ORDER BY objects.date, items.resource_uri, items.position', parameters):
+            yield row[0], invoicible.Item.from_json(dict(
+                (column, value) for column, value in zip(ITEM_COLUMNS, row[1:]) if value is not None))
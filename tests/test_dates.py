@@ -0,0 +1,18 @@
+import datetime
+import unittest
+
+import invoicible
+
+class ParseDateTest(unittest.TestCase):
+    def test_memoized_date_is_not_returned_as_datetime(self):
+        self.assertEqual(invoicible.parse_date('2010-01-05'), datetime.date(2010, 1, 5))
+        self.assertRaises(ValueError, invoicible.parse_datetime, '2010-01-05')
+
+    def test_memoized_datetime_is_not_returned_as_date(self):
+        value = invoicible.parse_datetime('2010-01-06 10:20:30')
+        self.assertEqual(value, datetime.datetime(2010, 1, 6, 10, 20, 30))
+        self.assertEqual(invoicible.parse_datetime('2010-01-06 10:20:30'), value)
+        self.assertRaises(ValueError, invoicible.parse_date, '2010-01-06 10:20:30')
+
+if __name__ == '__main__':
+    unittest.main()
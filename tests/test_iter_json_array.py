@@ -0,0 +1,55 @@
+# -coding: utf-8 -
+"""
+    python -m unittest discover -s tests -t .
+"""
+import random
+import unittest
+
+import simplejson
+
+import invoicible
+
+DOCUMENT = [0.5, 12345, -7, 1e5, 2.5e-3, u'zł', u'', True, False, None, [], {},
+        {'items': [{'amount': u'10', 'unit_price': u'0.99'}], 'summary': u'Usługi "IT"'}, [1, [2, [3]]]]
+
+def decoded(chunks):
+    return list(invoicible.iter_json_array(chunks))
+
+def split(data, boundaries):
+    boundaries = [0] + sorted(boundaries) + [len(data)]
+    return [data[start:end] for start, end in zip(boundaries, boundaries[1:])]
+
+class IterJsonArrayTest(unittest.TestCase):
+    def test_numbers_split_between_chunks(self):
+        self.assertEqual(decoded(['[0', '.', '5, 10]']), [0.5, 10])
+        self.assertEqual(decoded(['[12', '34', '5, 6]']), [12345, 6])
+        self.assertEqual(decoded(['[1', 'e', '5]']), [1e5])
+        self.assertEqual(decoded(['[-', '1', ' ', ']']), [-1])
+
+    def test_literals_and_whitespace_split_between_chunks(self):
+        self.assertEqual(decoded(['["a"', ' ', ', tru', 'e', ' ', ']']), [u'a', True])
+        self.assertEqual(decoded([' ', '[', ' ', ']', ' ']), [])
+
+    def test_every_chunk_boundary(self):
+        data = simplejson.dumps(DOCUMENT, indent=1)
+        for position in range(len(data) + 1):
+            self.assertEqual(decoded(split(data, [position])), DOCUMENT)
+
+    def test_random_chunk_boundaries(self):
+        rng = random.Random(0)
+        data = simplejson.dumps(DOCUMENT, ensure_ascii=False).encode('utf-8')
+        for i in range(500):
+            # utf-8 sequences are split too
+            boundaries = [rng.randint(0, len(data)) for j in range(rng.randint(1, 20))]
+            self.assertEqual(decoded(split(data, boundaries)), DOCUMENT)
+
+    def test_single_byte_chunks(self):
+        data = simplejson.dumps(DOCUMENT)
+        self.assertEqual(decoded(list(data)), DOCUMENT)
+
+    def test_invalid_arrays(self):
+        for chunks in (['{}'], ['[1 x]'], ['[1', ' 2]'], ['[1,'], ['[1] 2']):
+            self.assertRaises(ValueError, decoded, chunks)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import decimal
+import unittest
+
+import invoicible_reports
+
+def invoice(customer, *items):
+    return {'customer_uri': customer, 'items': [{'amount': a, 'unit_price': p} for a, p in items]}
+
+class LineItemTableTest(unittest.TestCase):
+    def assertAligned(self, table):
+        self.assertEqual(set(len(column) for column in table.columns.values()), set([len(table)]))
+
+    def test_invalid_number_does_not_misalign_columns(self):
+        table = invoicible_reports.LineItemTable()
+        table.load([invoice('A', ('1', '2'))])
+        self.assertRaises(ValueError, table.load, [invoice('B', ('x', '3'))])
+        table.load([invoice('C', ('1', '5'))])
+        self.assertAligned(table)
+        self.assertEqual(table.net(by='customer'), {'A': decimal.Decimal(2), 'C': decimal.Decimal(5)})
+
+    def test_values_above_64_bits(self):
+        table = invoicible_reports.LineItemTable()
+        table.load([invoice('A', ('1', '2')), invoice('B', ('1000000', '100000'), ('2', '1')), invoice('C', ('1', '5'))])
+        self.assertAligned(table)
+        self.assertEqual(table.net(by='customer'),
+                {'A': decimal.Decimal(2), 'B': decimal.Decimal(100000000002), 'C': decimal.Decimal(5)})
+
+if __name__ == '__main__':
+    unittest.main()